@@ -0,0 +1,384 @@
+"""EF 机器人处理器与数据库基准测试（离线运行，不连接 Telegram）
+
+用法：
+    # 在 1 万、10 万用户的合成数据库上各跑一轮，结果写入 bench_results.json
+    python bench_ef_bot.py --users 10000,100000
+
+    # 与上一次的结果比较，p99 变慢或吞吐下降超过 20% 时以非零状态退出
+    python bench_ef_bot.py --users 10000,1000000 --output new.json --baseline bench_results.json
+
+每一轮先生成指定用户数的合成数据库（用户、签到、订单、卡密），再用伪造的
+Update/CallbackQuery 直接驱动 start、handle_checkin、handle_price、handle_buy、
+handle_profile、handle_admin，并按处理器和数据库方法分别统计吞吐量与延迟分位数。
+机器人的发消息、编辑消息等调用只记录次数，不产生网络请求。
+"""
+import argparse
+import asyncio
+import functools
+import json
+import os
+import platform
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+from datetime import date, datetime, timedelta
+from typing import Dict, List, Optional
+
+import ef_telegram_bot as bot
+from fake_telegram import percentile
+
+# 合成数据的分布
+CHECKIN_USER_RATIO = 0.1  # 有签到记录的用户比例
+CHECKIN_MAX_DAYS = 14  # 每个签到用户最多连续签到的天数（截至昨天）
+ORDER_USER_RATIO = 0.1  # 有订单的用户比例
+SEED_CARDS = 2000  # 每种卡预置的卡密数
+SEED_CHUNK_SIZE = 20_000  # 生成数据时每次写入的行数
+
+FIRST_USER_ID = 10_000_000  # 合成用户的 Telegram ID 起点
+
+
+# ==================== 伪造的 Telegram 对象 ====================
+class FakeBot:
+    """只记录调用次数的机器人"""
+    def __init__(self):
+        self.calls: Dict[str, int] = {}
+
+    def record(self, method: str):
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+    async def send_message(self, chat_id, text, **kwargs):
+        self.record("send_message")
+
+    async def send_document(self, chat_id, document, **kwargs):
+        self.record("send_document")
+
+
+class FakeUser:
+    def __init__(self, user_id: int):
+        self.id = user_id
+        self.is_bot = False
+        self.username = f"user{user_id}"
+        self.first_name = f"User{user_id}"
+        self.last_name = None
+
+    def mention_markdown_v2(self) -> str:
+        return f"[{self.first_name}](tg://user?id={self.id})"
+
+
+class FakeMessage:
+    def __init__(self, fake_bot: FakeBot, user: FakeUser, text: str = ""):
+        self._bot = fake_bot
+        self.chat_id = user.id
+        self.message_id = 1
+        self.from_user = user
+        self.text = text
+
+    async def reply_text(self, text, **kwargs):
+        self._bot.record("reply_text")
+
+
+class FakeCallbackQuery:
+    def __init__(self, fake_bot: FakeBot, user: FakeUser, data: str):
+        self._bot = fake_bot
+        self.id = str(random.getrandbits(48))
+        self.from_user = user
+        self.data = data
+        self.message = FakeMessage(fake_bot, user)
+
+    async def answer(self, *args, **kwargs):
+        self._bot.record("answer_callback_query")
+
+    async def edit_message_text(self, text, **kwargs):
+        self._bot.record("edit_message_text")
+
+
+class FakeUpdate:
+    def __init__(self, user: FakeUser, message: Optional[FakeMessage] = None,
+                 callback_query: Optional[FakeCallbackQuery] = None):
+        self.effective_user = user
+        self.message = message
+        self.callback_query = callback_query
+
+
+class FakeContext:
+    def __init__(self, fake_bot: FakeBot):
+        self.bot = fake_bot
+        self.args: List[str] = []
+
+
+def command_update(fake_bot: FakeBot, user_id: int, text: str) -> FakeUpdate:
+    user = FakeUser(user_id)
+    return FakeUpdate(user, message=FakeMessage(fake_bot, user, text))
+
+
+def callback_update(fake_bot: FakeBot, user_id: int, data: str) -> FakeUpdate:
+    user = FakeUser(user_id)
+    return FakeUpdate(user, callback_query=FakeCallbackQuery(fake_bot, user, data))
+
+
+# ==================== 合成数据 ====================
+def seed_database(db: bot.Database, users: int, cards: Dict):
+    """向空数据库写入合成数据（按 user_id 写入对应分片）；cards 为价格表中的卡类型"""
+    today = date.today()
+    rng = random.Random(users)
+    backend = db.backend
+
+    def write_sharded(rows, sql: str):
+        """rows 的第一列为 user_id，按分片攒批写入"""
+        buffers = [[] for _ in backend.pools]
+        for row in rows:
+            buffer = buffers[backend.shard_of(row[0])]
+            buffer.append(row)
+            if len(buffer) >= SEED_CHUNK_SIZE:
+                with backend.pool_for(row[0]).write() as conn:
+                    conn.executemany(sql, buffer)
+                buffer.clear()
+        for pool, buffer in zip(backend.pools, buffers):
+            if buffer:
+                with pool.write() as conn:
+                    conn.executemany(sql, buffer)
+
+    def user_rows():
+        for i in range(users):
+            days = rng.randint(1, CHECKIN_MAX_DAYS) if rng.random() < CHECKIN_USER_RATIO else 0
+            created = today - timedelta(days=rng.randint(days, 365))
+            yield (
+                FIRST_USER_ID + i, f"user{FIRST_USER_ID + i}", f"User{i}", "",
+                days * 5, days * 10, days,
+                (today - timedelta(days=1)).isoformat() if days else None,
+                created.isoformat() + " 12:00:00",
+            )
+
+    write_sharded(user_rows(), '''
+        INSERT INTO users (user_id, username, first_name, last_name, coins, points,
+                           checkin_days, last_checkin, created_at)
+        VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ''')
+
+    def checkin_rows(conn):
+        for user_id, days in conn.execute('SELECT user_id, checkin_days FROM users WHERE checkin_days > 0'):
+            for d in range(days, 0, -1):
+                yield user_id, (today - timedelta(days=d)).isoformat(), 5, 10
+
+    def order_rows():
+        card_types = list(cards.items())
+        for i in range(users):
+            if rng.random() < ORDER_USER_RATIO:
+                card_type, card = rng.choice(card_types)
+                status = 'completed' if rng.random() < 0.5 else 'pending'
+                yield FIRST_USER_ID + i, db.next_order_no(), card_type, card["price"], status
+
+    write_sharded(
+        order_rows(),
+        'INSERT INTO orders (user_id, order_no, card_type, amount, status) VALUES (?, ?, ?, ?, ?)'
+    )
+    for pool in backend.pools:
+        with pool.write() as conn:
+            for chunk in bot.iter_chunks(checkin_rows(conn), SEED_CHUNK_SIZE):
+                conn.executemany('''
+                    INSERT INTO checkins (user_id, checkin_date, coins_earned, points_earned)
+                    VALUES (?, ?, ?, ?)
+                ''', chunk)
+            bot.backfill_checkin_bitmaps(conn.cursor())
+            conn.execute('ANALYZE')
+
+    for card_type, card in cards.items():
+        db.generate_cards(card_type, SEED_CARDS, card["price"])
+    db.recount_counters()
+
+
+# ==================== 计时 ====================
+class Recorder:
+    """按名称收集延迟（毫秒）"""
+    def __init__(self):
+        self.samples: Dict[str, List[float]] = {}
+
+    def add(self, name: str, elapsed_ms: float):
+        self.samples.setdefault(name, []).append(elapsed_ms)
+
+    def summary(self, name: str, wall: Optional[float] = None) -> Dict:
+        values = self.samples.get(name, [])
+        result = {
+            "count": len(values),
+            "mean_ms": round(sum(values) / len(values), 3) if values else 0.0,
+            "p50_ms": round(percentile(values, 50), 3),
+            "p90_ms": round(percentile(values, 90), 3),
+            "p99_ms": round(percentile(values, 99), 3),
+            "max_ms": round(max(values), 3) if values else 0.0,
+        }
+        if wall:
+            result["throughput"] = round(len(values) / wall, 1)
+        return result
+
+
+def instrument(async_db: bot.AsyncDatabase, recorder: Recorder):
+    """把 AsyncDatabase 的协程方法替换为计时版本（只作用于该实例）"""
+    for name in dir(bot.AsyncDatabase):
+        method = getattr(async_db, name)
+        if name.startswith("_") or not asyncio.iscoroutinefunction(method):
+            continue
+
+        def timed(method, name):
+            @functools.wraps(method)
+            async def wrapper(*args, **kwargs):
+                started = time.perf_counter()
+                try:
+                    return await method(*args, **kwargs)
+                finally:
+                    recorder.add(name, (time.perf_counter() - started) * 1000)
+            return wrapper
+
+        setattr(async_db, name, timed(method, name))
+
+
+# ==================== 压测场景 ====================
+def build_scenarios(fake_bot: FakeBot, users: int, requests: int, card_types: List[str]) -> Dict:
+    """每个处理器一个更新生成器：处理器名 -> (第 i 次请求 -> Update)"""
+    rng = random.Random(requests)
+    admin_id = bot.ADMIN_IDS[0]
+    # 签到按打乱后的顺序逐个用户进行，保证每次都是真正的签到写入
+    checkin_order = rng.sample(range(users), min(users, requests))
+
+    def existing_user() -> int:
+        return FIRST_USER_ID + rng.randrange(users)
+
+    return {
+        "start": lambda i: command_update(fake_bot, FIRST_USER_ID + users + i, "/start"),
+        "handle_checkin": lambda i: callback_update(
+            fake_bot, FIRST_USER_ID + checkin_order[i % len(checkin_order)], "checkin"),
+        "handle_price": lambda i: callback_update(fake_bot, existing_user(), "price"),
+        "handle_buy": lambda i: callback_update(fake_bot, existing_user(), f"buy:{rng.choice(card_types)}"),
+        "handle_profile": lambda i: callback_update(fake_bot, existing_user(), "profile"),
+        "handle_admin": lambda i: callback_update(fake_bot, admin_id, "admin"),
+    }
+
+
+async def run_handler(handlers: bot.EFBotHandlers, name: str, make_update, requests: int,
+                      concurrency: int, context: FakeContext, recorder: Recorder) -> float:
+    handler = getattr(handlers, name)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    async def one(i: int):
+        update = make_update(i)
+        async with semaphore:
+            started = time.perf_counter()
+            await handler(update, context)
+            recorder.add(name, (time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(i) for i in range(requests)))
+    return time.perf_counter() - started
+
+
+async def bench_size(users: int, requests: int, concurrency: int, db_dir: str, shards: int) -> Dict:
+    path = os.path.join(db_dir, f"bench_{users}.db")
+    for shard_path in bot.ShardedSQLiteBackend.shard_paths(path, shards):
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(shard_path + suffix):
+                os.remove(shard_path + suffix)
+
+    db = bot.Database(path, shards=shards)
+    service = bot.EFBotService(db)
+    cards = service.price_list["cards"]
+    started = time.perf_counter()
+    seed_database(db, users, cards)
+    seed_seconds = time.perf_counter() - started
+    print(f"🌱 {users} 用户的数据库已生成，用时 {seed_seconds:.1f}s")
+
+    handlers = bot.EFBotHandlers(service)
+    handler_recorder, db_recorder = Recorder(), Recorder()
+    instrument(handlers.db, db_recorder)
+    fake_bot = FakeBot()
+    context = FakeContext(fake_bot)
+
+    result = {"users": users, "shards": shards, "seed_seconds": round(seed_seconds, 2), "handlers": {}, "db": {}}
+    try:
+        for name, make_update in build_scenarios(fake_bot, users, requests, list(cards)).items():
+            wall = await run_handler(handlers, name, make_update, requests, concurrency,
+                                     context, handler_recorder)
+            result["handlers"][name] = handler_recorder.summary(name, wall)
+            stats = result["handlers"][name]
+            print(f"  {name:<16} {stats['throughput']:>9.1f}/s  "
+                  f"p50 {stats['p50_ms']:.2f}ms  p99 {stats['p99_ms']:.2f}ms")
+        result["db"] = {name: db_recorder.summary(name) for name in sorted(db_recorder.samples)}
+        result["user_cache"] = db.users.stats()
+        result["bot_calls"] = fake_bot.calls
+    finally:
+        handlers.db.close()
+    return result
+
+
+# ==================== 结果比较 ====================
+def compare(current: Dict, baseline: Dict, threshold: float) -> List[str]:
+    """按用户规模与处理器/数据库方法比较两次结果，返回退化项的描述"""
+    regressions = []
+    previous = {(run["users"], run.get("shards", 1)): run for run in baseline.get("runs", [])}
+    for run in current["runs"]:
+        old_run = previous.get((run["users"], run["shards"]))
+        if old_run is None:
+            continue
+        for group in ("handlers", "db"):
+            for name, stats in run[group].items():
+                old = old_run.get(group, {}).get(name)
+                if not old or not old["p99_ms"]:
+                    continue
+                p99_change = stats["p99_ms"] / old["p99_ms"] - 1
+                line = f"{run['users']:>8} {group}.{name:<24} p99 {old['p99_ms']:.2f} -> {stats['p99_ms']:.2f}ms ({p99_change:+.0%})"
+                worse = p99_change > threshold
+                if "throughput" in stats and old.get("throughput"):
+                    tp_change = stats["throughput"] / old["throughput"] - 1
+                    line += f"  吞吐 {tp_change:+.0%}"
+                    worse = worse or tp_change < -threshold
+                print(("⚠️ " if worse else "   ") + line)
+                if worse:
+                    regressions.append(line.strip())
+    return regressions
+
+
+async def main_async(args) -> Dict:
+    sizes = [int(size) for size in args.users.split(",")]
+    db_dir = args.db_dir or tempfile.mkdtemp(prefix="ef_bench_")
+    report = {
+        "created_at": datetime.now().isoformat(timespec="seconds"),
+        "python": platform.python_version(),
+        "sqlite": sqlite3.sqlite_version,
+        "requests": args.requests,
+        "concurrency": args.concurrency,
+        "shards": args.shards,
+        "runs": [],
+    }
+    for users in sizes:
+        report["runs"].append(await bench_size(users, args.requests, args.concurrency, db_dir, args.shards))
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description="EF 机器人处理器与数据库基准测试")
+    parser.add_argument("--users", default="10000,100000", help="合成数据库的用户数，逗号分隔")
+    parser.add_argument("--requests", type=int, default=2000, help="每个处理器的请求数")
+    parser.add_argument("--concurrency", type=int, default=bot.MAX_CONCURRENT_UPDATES, help="同时处理的请求数")
+    parser.add_argument("--shards", type=int, default=bot.DB_SHARDS, help="数据库分片数")
+    parser.add_argument("--db-dir", default="", help="存放合成数据库的目录，默认使用临时目录")
+    parser.add_argument("--output", default="bench_results.json", help="结果 JSON 文件")
+    parser.add_argument("--baseline", default="", help="用于比较的上一次结果 JSON 文件")
+    parser.add_argument("--threshold", type=float, default=0.2, help="判定为退化的变化比例")
+    args = parser.parse_args()
+
+    report = asyncio.run(main_async(args))
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f"📄 结果已写入 {args.output}")
+
+    if args.baseline:
+        with open(args.baseline, encoding="utf-8") as f:
+            regressions = compare(report, json.load(f), args.threshold)
+        if regressions:
+            print(f"❌ {len(regressions)} 项退化超过 {args.threshold:.0%}")
+            sys.exit(1)
+        print("✅ 未发现退化")
+
+
+if __name__ == '__main__':
+    main()
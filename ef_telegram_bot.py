@@ -1,10 +1,34 @@
 import logging
 import json
 import sqlite3
-from datetime import datetime, timedelta
-from typing import Dict, List, Optional
+from datetime import date, datetime, timedelta, timezone
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
 import asyncio
+import base64
+import bisect
+import csv
+import functools
+import gzip
+import hashlib
+import io
+import os
+import pickle
+import queue
+import random
+import re
+import secrets
+import socket
+import tempfile
+import threading
+import time
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager
 
+try:
+    from matplotlib.figure import Figure
+except ImportError:  # 没有 matplotlib 时数据统计只显示文字
+    Figure = None
 from telegram import (
     Update, 
     InlineKeyboardButton, 
@@ -13,154 +37,2160 @@ from telegram import (
     KeyboardButton,
     WebAppInfo
 )
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter
+from telegram.helpers import escape_markdown
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application,
+    BasePersistence,
+    BaseUpdateProcessor,
     CommandHandler,
     CallbackQueryHandler,
     MessageHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    ConversationHandler,
+    PersistenceInput
 )
 
 # ==================== 配置 ====================
 logging.basicConfig(
-    format='%(asctime)s - %(name)s - %levelname)s - %(message)s',
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s',
     level=logging.INFO
 )
+logger = logging.getLogger(__name__)
 
 TOKEN = "YOUR_BOT_TOKEN"
 ADMIN_IDS = [751440488, 123456789]  # 管理员ID列表
 DATABASE = "ef_bot.db"
 
+# 运行模式：polling（长轮询）或 webhook（本地 HTTP 服务接收推送）
+RUN_MODE = os.environ.get("EF_RUN_MODE", "polling")
+WEBHOOK_LISTEN = os.environ.get("EF_WEBHOOK_LISTEN", "127.0.0.1")
+WEBHOOK_PORT = int(os.environ.get("EF_WEBHOOK_PORT", "8443"))
+WEBHOOK_URL = os.environ.get("EF_WEBHOOK_URL", "")  # 对外地址，如 https://bot.example.com
+WEBHOOK_PATH = "telegram"
+WEBHOOK_SECRET = os.environ.get("EF_WEBHOOK_SECRET", "")
+MAX_CONCURRENT_UPDATES = 64  # 同时处理的更新数上限（同一用户始终串行）
+TELEGRAM_API_BASE = os.environ.get("EF_TELEGRAM_API", "")  # 为空时使用官方 API，测试时指向 fake_telegram.py
+DB_SHARDS = int(os.environ.get("EF_DB_SHARDS", "1"))  # 用户数据分片的 SQLite 文件数，建库后不可更改
+READ_POOL_SIZE = 4  # 每个分片的只读连接数
+DB_BUSY_TIMEOUT = 5.0  # 等待数据库锁的秒数
+WRITE_BATCH_SIZE = 256  # 单个事务最多合并的写操作数
+WRITE_BATCH_DELAY = 0.002  # 凑批最多等待的秒数
+USER_CACHE_SIZE = 100_000  # 内存中最多缓存的用户数
+USER_CACHE_TTL = 600  # 用户缓存有效期（秒）
+CARD_CHUNK_SIZE = 5000  # 批量生成/导入卡密时每个事务的行数
+CARD_GEN_MAX = 200_000  # 单次最多生成的卡密数
+ORDER_WORKER_LEASE_TTL = 60  # 订单机器号租约有效期（秒），心跳间隔为其 1/3
+# 待支付订单的有效期（秒），超时后标记为 expired；付款后要等客服 /confirm，需留足人工处理的时间
+ORDER_TTL = int(os.environ.get("EF_ORDER_TTL", str(24 * 3600)))
+ORDER_SWEEP_INTERVAL = 300  # 过期订单清理的间隔（秒）
+# 多个进程共用数据库时，各自的内存计数器和排行榜看不到其他进程的写入，按此间隔从库里重新同步；0 表示不同步
+MIRROR_RESYNC_INTERVAL = int(os.environ.get("EF_MIRROR_RESYNC_INTERVAL", "60"))
+ORDER_SWEEP_BATCH = 500  # 每个写事务最多处理的过期订单数
+STATS_PERIODS = (7, 30, 90)  # 数据统计页汇总的天数
+LEADERBOARD_METRICS = {"coins": "💰 金币", "points": "⭐ 积分", "checkin_days": "📅 签到天数"}
+LEADERBOARD_SIZE = 10  # 排行榜显示人数
+LEADERBOARD_KEEP = 200  # 内存中为每个指标保留的前 N 名
+FLOOD_RATE = 2  # 每个用户每秒可执行的操作数
+FLOOD_BURST = 5  # 每个用户允许的突发操作数
+FLOOD_DEDUP_WINDOW = 2.0  # 相同操作在该秒数内重复点击只执行一次
+FLOOD_MAX_USERS = 50_000  # 内存中保留限流状态的用户数
+BROADCAST_RATE = 25  # 群发全局速率（条/秒），Telegram 上限约 30
+BROADCAST_PER_CHAT_RATE = 1  # 同一会话的发送速率（条/秒）
+BROADCAST_PAGE_SIZE = 50  # 每页读取的接收人数，每页结束保存一次进度
+BROADCAST_CONCURRENCY = 8  # 同时进行中的发送请求数
+BROADCAST_MAX_RETRIES = 3  # 网络错误的重试次数
+BROADCAST_MAX_CHATS = 10000  # 最多保留多少个会话的令牌桶（最久未用的先淘汰）
+EXPORT_TABLES = ("users", "orders", "checkins")  # 允许导出的表
+EXPORT_CHUNK_SIZE = 2000  # 导出时每次读取的行数
+HISTORY_PAGE_SIZE = 10  # 签到/订单记录每页条数
+USER_PAGE_SIZE = 10  # 管理员用户列表/搜索结果每页条数
+USER_SEARCH_MIN_LENGTH = 3  # trigram 索引至少需要 3 个字符
+PERSISTENCE_UPDATE_INTERVAL = 10  # 会话状态写回数据库的间隔（秒）
+METRICS_LISTEN = os.environ.get("EF_METRICS_LISTEN", "127.0.0.1")
+METRICS_PORT = int(os.environ.get("EF_METRICS_PORT", "9108"))  # Prometheus 抓取端口，0 表示不启动
+METRICS_SAMPLE_RATE = float(os.environ.get("EF_METRICS_SAMPLE_RATE", "0.1"))  # 测量耗时的调用比例，次数始终全量统计
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)  # 秒
+
 # 对话状态
 CHECKIN, BUY_CARD, CONTACT_ADMIN = range(3)
 
+# 欢迎语模板，{mention} 为用户的 MarkdownV2 提及
+WELCOME_TEMPLATE = """
+🤖 *欢迎使用 EF 用户帮助机器人*
+
+👋 你好 {mention}！
+
+我们为您提供专业的卡密服务和代理咨询。
+
+📋 *主要功能：*
+• 卡密价格查询
+• 代理政策咨询
+• 用户账户管理
+• 在线客服支持
+
+💡 *快速操作：*
+使用下方按钮或发送命令
+"""
+
+# ==================== 监控指标 ====================
+# 指标族：名称 -> (标签名, 说明)
+METRIC_FAMILIES = {
+    "handler": ("handler", "处理器"),
+    "db": ("method", "数据库调用"),
+    "telegram_api": ("method", "Telegram API 调用"),
+}
+
+
+class MetricSeries:
+    """一个标签值的调用次数、错误数与耗时直方图"""
+    __slots__ = ("calls", "errors", "buckets", "sampled", "total")
+    
+    def __init__(self, size: int):
+        self.calls = 0
+        self.errors = 0
+        self.buckets = [0] * size  # 每个桶（不累积），最后一个为 +Inf
+        self.sampled = 0
+        self.total = 0.0
+    
+    def quantile(self, q: float, bounds: Tuple[float, ...]) -> float:
+        """按桶线性插值估算分位数（秒），与 Prometheus 的 histogram_quantile 一致"""
+        if not self.sampled:
+            return 0.0
+        rank = q * self.sampled
+        seen = 0
+        for i, count in enumerate(self.buckets):
+            if seen + count >= rank and count:
+                if i == len(bounds):
+                    return bounds[-1]
+                lower = bounds[i - 1] if i else 0.0
+                return lower + (bounds[i] - lower) * (rank - seen) / count
+            seen += count
+        return bounds[-1]
+
+
+class Metrics:
+    """进程内指标：按指标族和标签统计次数、错误和耗时直方图
+    
+    次数和错误每次都计；耗时只对 sample_rate 比例的调用测量，未抽中的
+    调用不读时钟。写线程也会上报，所以更新都在锁内进行。
+    """
+    def __init__(self, sample_rate: float = METRICS_SAMPLE_RATE,
+                 bounds: Tuple[float, ...] = LATENCY_BUCKETS):
+        self.sample_rate = sample_rate
+        self.bounds = bounds
+        self._lock = threading.Lock()
+        self._series: Dict[Tuple[str, str], MetricSeries] = {}
+        self._counters: Dict[str, Tuple[str, float]] = {}  # 名称 -> (说明, 值)
+        self._gauges: Dict[str, Tuple[str, object]] = {}  # 名称 -> (说明, 取值函数)
+    
+    def sampled(self) -> bool:
+        return self.sample_rate >= 1 or random.random() < self.sample_rate
+    
+    def record(self, family: str, label: str, seconds: Optional[float] = None, error: bool = False):
+        """记录一次调用；seconds 为空表示本次未抽样计时"""
+        with self._lock:
+            series = self._series.get((family, label))
+            if series is None:
+                series = self._series[(family, label)] = MetricSeries(len(self.bounds) + 1)
+            series.calls += 1
+            if error:
+                series.errors += 1
+            if seconds is not None:
+                series.buckets[bisect.bisect_left(self.bounds, seconds)] += 1
+                series.sampled += 1
+                series.total += seconds
+    
+    async def timed(self, family: str, label: str, awaitable):
+        """等待 awaitable 并记录一次调用"""
+        started = time.perf_counter() if self.sampled() else None
+        error = False
+        try:
+            return await awaitable
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.record(family, label, None if started is None else time.perf_counter() - started, error)
+    
+    def track_handler(self, handler, name: Optional[str] = None):
+        """包装处理器，按名称记录调用"""
+        name = name or handler.__name__
+        
+        @functools.wraps(handler)
+        async def tracked(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            return await self.timed("handler", name, handler(update, context))
+        
+        return tracked
+    
+    def count(self, name: str, help_text: str, value: float = 1):
+        with self._lock:
+            current = self._counters.get(name, (help_text, 0))[1]
+            self._counters[name] = (help_text, current + value)
+    
+    def gauge(self, name: str, help_text: str, func):
+        """登记一个在导出时才取值的指标"""
+        self._gauges[name] = (help_text, func)
+    
+    def snapshot(self, family: str) -> List[Dict]:
+        """某指标族各标签的统计，按调用次数降序"""
+        with self._lock:
+            items = [(label, series) for (fam, label), series in self._series.items() if fam == family]
+            return sorted((
+                {
+                    "label": label,
+                    "calls": series.calls,
+                    "errors": series.errors,
+                    "p50": series.quantile(0.5, self.bounds),
+                    "p99": series.quantile(0.99, self.bounds),
+                }
+                for label, series in items
+            ), key=lambda row: -row["calls"])
+    
+    def render_prometheus(self) -> str:
+        """导出为 Prometheus 文本格式"""
+        lines = []
+        with self._lock:
+            series_items = sorted(self._series.items())
+            counters = sorted(self._counters.items())
+        
+        for family, (label_name, desc) in METRIC_FAMILIES.items():
+            rows = [(label, series) for (fam, label), series in series_items if fam == family]
+            prefix = f"ef_{family}"
+            lines += [f"# HELP {prefix}_calls_total {desc}次数", f"# TYPE {prefix}_calls_total counter"]
+            lines += [f'{prefix}_calls_total{{{label_name}="{label}"}} {s.calls}' for label, s in rows]
+            lines += [f"# HELP {prefix}_errors_total {desc}失败次数", f"# TYPE {prefix}_errors_total counter"]
+            lines += [f'{prefix}_errors_total{{{label_name}="{label}"}} {s.errors}' for label, s in rows]
+            lines += [f"# HELP {prefix}_seconds {desc}耗时（抽样）", f"# TYPE {prefix}_seconds histogram"]
+            for label, s in rows:
+                cumulative = 0
+                for bound, count in zip(self.bounds + ("+Inf",), s.buckets):
+                    cumulative += count
+                    lines.append(f'{prefix}_seconds_bucket{{{label_name}="{label}",le="{bound}"}} {cumulative}')
+                lines.append(f'{prefix}_seconds_sum{{{label_name}="{label}"}} {s.total}')
+                lines.append(f'{prefix}_seconds_count{{{label_name}="{label}"}} {s.sampled}')
+        
+        for name, (help_text, value) in counters:
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} counter", f"{name} {value}"]
+        for name, (help_text, func) in sorted(self._gauges.items()):
+            lines += [f"# HELP {name} {help_text}", f"# TYPE {name} gauge", f"{name} {func()}"]
+        return "\n".join(lines) + "\n"
+
+
+metrics = Metrics()
+
+
+class InstrumentedRequest(HTTPXRequest):
+    """记录每次 Bot API 调用的 HTTPXRequest"""
+    async def do_request(self, url: str, method: str, request_data=None, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        started = time.perf_counter() if metrics.sampled() else None
+        code = 0
+        try:
+            code, payload = await super().do_request(url, method, request_data, *args, **kwargs)
+            return code, payload
+        finally:
+            metrics.record(
+                "telegram_api", api_method,
+                None if started is None else time.perf_counter() - started,
+                error=not 200 <= code < 300
+            )
+
+
+async def serve_metrics(host: str, port: int):
+    """本地 HTTP 服务：GET /metrics 返回 Prometheus 文本格式"""
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        try:
+            request_line = await reader.readline()
+            while (await reader.readline()) not in (b"\r\n", b"\n", b""):
+                pass
+            path = request_line.decode(errors="replace").split(" ")[1:2]
+            if path == ["/metrics"]:
+                status, body = "200 OK", metrics.render_prometheus().encode()
+            else:
+                status, body = "404 Not Found", b"not found\n"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        except ConnectionError:
+            pass
+        finally:
+            writer.close()
+    
+    return await asyncio.start_server(handle, host, port)
+
 # ==================== 数据库 ====================
+# created_at 由 CURRENT_TIMESTAMP 写入，是 UTC 时间；按日统计一律换成本地日期，
+# 与 datetime.now() 取的“今天”保持一致
+LOCAL_DAY_SQL = "date(created_at, 'localtime')"
+
+
+def local_day(utc_timestamp: str) -> str:
+    """created_at（UTC）对应的本地日期，与 LOCAL_DAY_SQL 相同"""
+    moment = datetime.strptime(utc_timestamp[:19], "%Y-%m-%d %H:%M:%S").replace(tzinfo=timezone.utc)
+    return moment.astimezone().strftime("%Y-%m-%d")
+
+
+# 计数器的重算查询，每条返回 (name, value)
+COUNTER_QUERIES = (
+    "SELECT 'users', COUNT(*) FROM users",
+    f"SELECT 'users_day:' || {LOCAL_DAY_SQL}, COUNT(*) FROM users GROUP BY {LOCAL_DAY_SQL}",
+    "SELECT 'orders', COUNT(*) FROM orders",
+    "SELECT 'sales', COALESCE(SUM(amount), 0) FROM orders WHERE status = 'completed'",
+    "SELECT 'stock:' || card_type, COUNT(*) FROM card_stock WHERE is_sold = 0 GROUP BY card_type",
+)
+
+# 按日汇总的重算查询，每条返回 (day, metric, value)
+#
+# 日期取各行自己的日期字段：注册和下单为 created_at 换算的本地日期，签到为
+# checkin_date（本身就是本地日期）；完成订单的收入计在下单当天。
+DAILY_STATS_QUERIES = (
+    f"SELECT {LOCAL_DAY_SQL}, 'signups', COUNT(*) FROM users GROUP BY 1",
+    "SELECT checkin_date, 'checkins', COUNT(*) FROM checkins GROUP BY 1",
+    f"SELECT {LOCAL_DAY_SQL}, 'orders', COUNT(*) FROM orders GROUP BY 1",
+    f"SELECT {LOCAL_DAY_SQL}, 'orders:' || card_type, COUNT(*) FROM orders GROUP BY 1, 2",
+    f"SELECT {LOCAL_DAY_SQL}, 'revenue', SUM(amount) FROM orders "
+    "WHERE status = 'completed' GROUP BY 1",
+    f"SELECT {LOCAL_DAY_SQL}, 'revenue:' || card_type, SUM(amount) FROM orders "
+    "WHERE status = 'completed' GROUP BY 1, 2",
+)
+
+
+def rebuild_counters(cursor):
+    """从原始数据重新统计全部计数器（全表扫描，仅用于迁移）"""
+    cursor.execute('DELETE FROM stats_counters')
+    for sql in COUNTER_QUERIES:
+        cursor.execute(f'INSERT INTO stats_counters (name, value) {sql}')
+
+
+def rebuild_daily_stats(cursor):
+    """从原始数据重新生成按日汇总（全表扫描，仅用于迁移）"""
+    cursor.execute('DELETE FROM daily_stats')
+    for sql in DAILY_STATS_QUERIES:
+        cursor.execute(f'INSERT INTO daily_stats (day, metric, value) {sql}')
+
+
+def run_length_ending(bits: int, day: int) -> int:
+    """月签到位图中以第 day 天结尾的连续签到天数（第 d 天对应第 d-1 位）"""
+    zeros = ~bits & ((1 << day) - 1)
+    return day - zeros.bit_length()
+
+
+def backfill_checkin_bitmaps(cursor):
+    """由 checkins 表回填签到位图（按位或合并，可重复执行）"""
+    rows = cursor.connection.execute('''
+        SELECT user_id, substr(checkin_date, 1, 7), CAST(substr(checkin_date, 9, 2) AS INTEGER)
+        FROM checkins ORDER BY user_id, checkin_date
+    ''')
+    
+    def bitmaps():
+        key, bits = None, 0
+        for user_id, month, day in rows:
+            if (user_id, month) != key:
+                if key is not None:
+                    yield key + (bits,)
+                key, bits = (user_id, month), 0
+            bits |= 1 << (day - 1)
+        if key is not None:
+            yield key + (bits,)
+    
+    for chunk in iter_chunks(bitmaps(), CARD_CHUNK_SIZE):
+        cursor.executemany('''
+            INSERT INTO checkin_bitmaps (user_id, month, bits) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, month) DO UPDATE SET bits = bits | excluded.bits
+        ''', chunk)
+
+
+# 数据库迁移：(版本号, 说明, 步骤列表)，步骤为 SQL 语句或接收 cursor 的函数。
+# 已发布的迁移不能修改，结构变更一律追加新版本。
+MIGRATIONS = [
+    (1, "初始表结构", [
+        # 用户表
+        '''
+        CREATE TABLE IF NOT EXISTS users (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER UNIQUE,
+            username TEXT,
+            first_name TEXT,
+            last_name TEXT,
+            coins INTEGER DEFAULT 0,
+            points INTEGER DEFAULT 0,
+            total_spent REAL DEFAULT 0.0,
+            checkin_days INTEGER DEFAULT 0,
+            last_checkin TEXT,
+            is_vip INTEGER DEFAULT 0,
+            vip_expiry TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        # 签到记录
+        '''
+        CREATE TABLE IF NOT EXISTS checkins (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            checkin_date TEXT,
+            coins_earned INTEGER,
+            points_earned INTEGER,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        # 订单记录
+        '''
+        CREATE TABLE IF NOT EXISTS orders (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            user_id INTEGER,
+            order_no TEXT UNIQUE,
+            card_type TEXT,
+            amount REAL,
+            status TEXT DEFAULT 'pending',
+            payment_info TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            FOREIGN KEY (user_id) REFERENCES users (user_id)
+        )
+        ''',
+        # 卡密库存
+        '''
+        CREATE TABLE IF NOT EXISTS card_stock (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            card_type TEXT,
+            card_key TEXT UNIQUE,
+            price REAL,
+            is_sold INTEGER DEFAULT 0,
+            sold_to INTEGER,
+            sold_at TEXT,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+    ]),
+    (2, "热点查询索引", [
+        # 个人信息页：本月签到天数
+        'CREATE INDEX IF NOT EXISTS idx_checkins_user_date ON checkins (user_id, checkin_date)',
+        # 管理面板：已完成订单销售额（覆盖索引，无需回表）
+        'CREATE INDEX IF NOT EXISTS idx_orders_status_amount ON orders (status, amount)',
+        # 管理面板：今日新增用户
+        'CREATE INDEX IF NOT EXISTS idx_users_created_at ON users (created_at)',
+    ]),
+    (3, "统计计数器", [
+        '''
+        CREATE TABLE IF NOT EXISTS stats_counters (
+            name TEXT PRIMARY KEY,
+            value REAL NOT NULL DEFAULT 0
+        )
+        ''',
+        rebuild_counters,
+    ]),
+    (4, "卡密发放", [
+        'ALTER TABLE card_stock ADD COLUMN order_no TEXT',
+        # 按类型取第一张未售卡密：索引末尾隐含 id，无需扫描已售出的行
+        'CREATE INDEX IF NOT EXISTS idx_card_stock_available ON card_stock (card_type, is_sold)',
+    ]),
+    (5, "订单号机器号租约", [
+        '''
+        CREATE TABLE IF NOT EXISTS worker_leases (
+            worker_id INTEGER PRIMARY KEY,
+            owner TEXT NOT NULL,
+            heartbeat REAL NOT NULL
+        )
+        ''',
+    ]),
+    (6, "群发任务", [
+        '''
+        CREATE TABLE IF NOT EXISTS broadcasts (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            text TEXT NOT NULL,
+            created_by INTEGER,
+            chat_id INTEGER,
+            status TEXT DEFAULT 'running',
+            last_user_pk INTEGER DEFAULT 0,
+            sent INTEGER DEFAULT 0,
+            failed INTEGER DEFAULT 0,
+            blocked INTEGER DEFAULT 0,
+            elapsed REAL DEFAULT 0,
+            created_at TEXT DEFAULT CURRENT_TIMESTAMP,
+            finished_at TEXT
+        )
+        ''',
+    ]),
+    (7, "签到位图", [
+        # 每个用户每月一个整数，第 d 天签到则第 d-1 位为 1
+        '''
+        CREATE TABLE IF NOT EXISTS checkin_bitmaps (
+            user_id INTEGER NOT NULL,
+            month TEXT NOT NULL,
+            bits INTEGER NOT NULL DEFAULT 0,
+            PRIMARY KEY (user_id, month)
+        ) WITHOUT ROWID
+        ''',
+        backfill_checkin_bitmaps,
+    ]),
+    (8, "历史记录分页", [
+        # 按 (user_id, id) keyset 翻页，任意深度都只读一页的行
+        'CREATE INDEX IF NOT EXISTS idx_checkins_user_id ON checkins (user_id, id)',
+        'CREATE INDEX IF NOT EXISTS idx_orders_user_id ON orders (user_id, id)',
+    ]),
+    (9, "分片布局", [
+        # 记录分片数与本文件的分片编号，防止改变分片数后用户被路由到错误的文件
+        '''
+        CREATE TABLE IF NOT EXISTS storage_meta (
+            key TEXT PRIMARY KEY,
+            value TEXT NOT NULL
+        )
+        ''',
+    ]),
+    (10, "会话状态", [
+        # 每个用户一行 pickle，随用户分片；conversations 只在 0 号分片
+        '''
+        CREATE TABLE IF NOT EXISTS user_state (
+            user_id INTEGER PRIMARY KEY,
+            data BLOB NOT NULL,
+            updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+        )
+        ''',
+        '''
+        CREATE TABLE IF NOT EXISTS conversations (
+            name TEXT NOT NULL,
+            key TEXT NOT NULL,
+            state BLOB NOT NULL,
+            PRIMARY KEY (name, key)
+        ) WITHOUT ROWID
+        ''',
+    ]),
+    (11, "过期订单清理", [
+        # 按 (status, created_at) 直接定位最早的待支付订单
+        'CREATE INDEX IF NOT EXISTS idx_orders_status_created ON orders (status, created_at)',
+    ]),
+    (12, "按日汇总", [
+        '''
+        CREATE TABLE IF NOT EXISTS daily_stats (
+            day TEXT NOT NULL,
+            metric TEXT NOT NULL,
+            value REAL NOT NULL DEFAULT 0,
+            PRIMARY KEY (day, metric)
+        ) WITHOUT ROWID
+        ''',
+        rebuild_daily_stats,
+    ]),
+    (13, "用户搜索索引", [
+        # 外部内容表，只存 trigram 索引；用户名字段只在注册时写入，由 create_user 同步
+        '''
+        CREATE VIRTUAL TABLE IF NOT EXISTS user_search USING fts5(
+            username, first_name, last_name,
+            content='users', content_rowid='id', tokenize='trigram'
+        )
+        ''',
+        "INSERT INTO user_search (user_search) VALUES ('rebuild')",
+    ]),
+    (14, "排行榜索引", [
+        # 带上 user_id，ORDER BY 分数 DESC, user_id DESC 和“我的排名”的计数都只走索引
+        'CREATE INDEX IF NOT EXISTS idx_users_coins ON users (coins, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_points ON users (points, user_id)',
+        'CREATE INDEX IF NOT EXISTS idx_users_checkin_days ON users (checkin_days, user_id)',
+    ]),
+    # 之前 users_day: 按 UTC 日期计数，与管理面板按本地日期读取不一致
+    (15, "每日新增按本地日期", [rebuild_counters]),
+    (16, "按日汇总按本地日期", [rebuild_daily_stats]),
+]
+
+
+def new_card_key() -> str:
+    """生成一个随机卡密：80 位随机数，Base32 编码后每 4 位一组"""
+    raw = base64.b32encode(secrets.token_bytes(10)).decode()
+    return "EF-" + "-".join(raw[i:i + 4] for i in range(0, 16, 4))
+
+
+def iter_chunks(items: Iterable, size: int):
+    """把可迭代对象切成列表块，任何时刻只在内存中保留一块"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def csv_lines(columns: List[str], rows: Iterable[tuple]):
+    """把行流转换为 CSV 文本行流（首行为表头）"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow(row)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    # 空表时缓冲区里只有表头
+    yield buffer.getvalue()
+
+
+def jsonl_lines(columns: List[str], rows: Iterable[tuple]):
+    """把行流转换为 JSON Lines 文本行流"""
+    for row in rows:
+        yield json.dumps(dict(zip(columns, row)), ensure_ascii=False) + "\n"
+
+
+USER_COLUMNS = (
+    'id', 'user_id', 'username', 'first_name', 'last_name', 'coins', 'points',
+    'total_spent', 'checkin_days', 'last_checkin', 'is_vip', 'vip_expiry', 'created_at'
+)
+USER_SELECT = f"SELECT {', '.join(USER_COLUMNS)} FROM users"
+
+
+class UserRecord:
+    """用户记录，按字段名访问，替代按下标取值的元组"""
+    __slots__ = USER_COLUMNS
+    
+    def __init__(self, row):
+        for name, value in zip(USER_COLUMNS, row):
+            setattr(self, name, value)
+    
+    def __repr__(self):
+        return f"UserRecord(user_id={self.user_id}, username={self.username!r})"
+
+
+class UserCache:
+    """用户记录缓存（LRU + TTL）
+    
+    读路径只在未命中时才查库；写线程在事务提交后把最新记录写回缓存。
+    记录对象不可原地修改，更新一律整体替换，读到的记录不会被改一半。
+    """
+    def __init__(self, max_size: int = USER_CACHE_SIZE, ttl: float = USER_CACHE_TTL):
+        self.max_size = max_size
+        self.ttl = ttl
+        self._data = OrderedDict()  # user_id -> (过期时间, UserRecord)
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    def get(self, user_id: int) -> Optional[UserRecord]:
+        with self._lock:
+            entry = self._data.get(user_id)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires_at, record = entry
+            if expires_at < time.monotonic():
+                del self._data[user_id]
+                self.misses += 1
+                return None
+            self._data.move_to_end(user_id)
+            self.hits += 1
+            return record
+    
+    def put(self, record: UserRecord, overwrite: bool = True):
+        """写入缓存；overwrite=False 用于查库回填，避免覆盖写线程刚写回的新值"""
+        with self._lock:
+            if not overwrite and record.user_id in self._data:
+                return
+            self._data[record.user_id] = (time.monotonic() + self.ttl, record)
+            self._data.move_to_end(record.user_id)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+                self.evictions += 1
+    
+    def invalidate(self, user_id: int):
+        with self._lock:
+            self._data.pop(user_id, None)
+    
+    def stats(self) -> Dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "size": len(self._data),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / total if total else 0.0,
+            }
+
+
+class LeaseExpired(RuntimeError):
+    """订单机器号租约过期，续约前不能生成订单号"""
+
+
+class OrderIdGenerator:
+    """订单号生成器（类 Snowflake）
+    
+    41 位毫秒时间戳 | 10 位机器号 | 12 位序列号。机器号由数据库租约分配，
+    多个进程同时运行时各自独占一个机器号。同一毫秒内序列号用尽时借用
+    下一毫秒，时钟回拨时沿用上次的时间戳，生成的 ID 严格递增、不会重复。
+    
+    租约只在有效期内属于本进程：进程停顿超过 TTL 后机器号可能已被其他
+    进程接管，此时 next_id 抛出 LeaseExpired，续约成功前不再生成。
+    """
+    EPOCH_MS = 1704067200000  # 2024-01-01 00:00:00 UTC
+    WORKER_BITS = 10
+    SEQUENCE_BITS = 12
+    MAX_WORKERS = 1 << WORKER_BITS
+    
+    def __init__(self, worker_id: int, lease_ttl: float = ORDER_WORKER_LEASE_TTL):
+        self.worker_id = worker_id
+        self.lease_ttl = lease_ttl
+        self._lease_until = time.monotonic() + lease_ttl
+        self._lock = threading.Lock()
+        self._last_ms = 0
+        self._sequence = 0
+    
+    def renewed(self, started: float, worker_id: Optional[int] = None):
+        """记录一次成功的续约或重新申请；started 为发起续约前的 time.monotonic()"""
+        with self._lock:
+            if worker_id is not None:
+                self.worker_id = worker_id
+            self._lease_until = started + self.lease_ttl
+    
+    def next_id(self) -> int:
+        with self._lock:
+            if time.monotonic() >= self._lease_until:
+                raise LeaseExpired(f"订单机器号 {self.worker_id} 的租约已过期")
+            now = max(int(time.time() * 1000), self._last_ms)
+            if now == self._last_ms:
+                self._sequence = (self._sequence + 1) & ((1 << self.SEQUENCE_BITS) - 1)
+                if self._sequence == 0:
+                    now += 1
+            else:
+                self._sequence = 0
+            self._last_ms = now
+            return (
+                ((now - self.EPOCH_MS) << (self.WORKER_BITS + self.SEQUENCE_BITS))
+                | (self.worker_id << self.SEQUENCE_BITS)
+                | self._sequence
+            )
+    
+    def next_order_no(self) -> str:
+        """订单号：补零到 19 位，字符串顺序即创建时间顺序"""
+        return f"{self.next_id():019d}"
+
+
+class StatsCounters:
+    """统计计数器的内存镜像
+    
+    计数器在写事务中随业务数据一起更新，提交后再同步到这里，
+    管理面板直接读内存，不再对大表做 COUNT/SUM。
+    """
+    def __init__(self):
+        self._values: Dict[str, float] = {}
+        self._lock = threading.Lock()
+    
+    def add(self, name: str, delta: float):
+        with self._lock:
+            self._values[name] = self._values.get(name, 0) + delta
+    
+    def replace(self, values: Dict[str, float]):
+        with self._lock:
+            self._values = dict(values)
+    
+    def snapshot(self) -> Dict[str, float]:
+        with self._lock:
+            return dict(self._values)
+
+
+class Leaderboard:
+    """各指标前 N 名的内存有序表
+    
+    每个指标一个按 (-分数, -user_id) 排序的列表，始终是全体用户中准确的
+    前若干名。用户记录提交后带着最新分数调用 update：仍在榜内的原地移动，
+    榜外的只有超过榜尾才插入。榜内用户分数下降到榜尾以下时无法知道榜外
+    谁该补位，只能把他移出，榜单因此变短；短于显示人数时由 load 从
+    数据库按索引重新取前 keep 名。
+    """
+    def __init__(self, load, keep: int = LEADERBOARD_KEEP):
+        self._load = load  # (指标, 人数) -> ([(分数, user_id), ...], 是否还有榜外用户)
+        self.keep = keep
+        self._boards: Dict[str, List[Tuple[float, int]]] = {}
+        self._scores: Dict[str, Dict[int, float]] = {}
+        self._truncated: Dict[str, bool] = {}
+        self._lock = threading.Lock()
+    
+    def reload(self, metric: str):
+        with self._lock:
+            self._reload(metric)
+    
+    def _reload(self, metric: str):
+        rows, truncated = self._load(metric, self.keep)
+        self._boards[metric] = sorted((-score, -user_id) for score, user_id in rows)
+        self._scores[metric] = {user_id: score for score, user_id in rows}
+        self._truncated[metric] = truncated
+    
+    def update(self, user_id: int, scores: Dict[str, float]):
+        with self._lock:
+            for metric, score in scores.items():
+                board = self._boards.get(metric)
+                if board is None:
+                    continue
+                members = self._scores[metric]
+                old = members.get(user_id)
+                if old == score:
+                    continue
+                if old is not None:
+                    board.pop(bisect.bisect_left(board, (-old, -user_id)))
+                    del members[user_id]
+                entry = (-score, -user_id)
+                # 榜内是全体用户的准确前若干名：没有榜外用户，或比榜尾高，才能放进来
+                if not self._truncated[metric] or (board and entry < board[-1]):
+                    bisect.insort(board, entry)
+                    members[user_id] = score
+                    if len(board) > self.keep:
+                        _, dropped = board.pop()
+                        del members[-dropped]
+                        self._truncated[metric] = True
+    
+    def top(self, metric: str, limit: int = LEADERBOARD_SIZE) -> List[Tuple[float, int]]:
+        """前 limit 名 [(分数, user_id)]"""
+        with self._lock:
+            board = self._boards.get(metric)
+            if board is None or len(board) < limit and self._truncated[metric]:
+                self._reload(metric)
+                board = self._boards[metric]
+            return [(-score, -user_id) for score, user_id in board[:limit]]
+    
+    def rank_in_board(self, metric: str, score: float) -> Optional[int]:
+        """分数在榜内时直接算名次（同分同名次），否则返回 None"""
+        with self._lock:
+            board = self._boards.get(metric)
+            if not board or (self._truncated[metric] and (-score, float("-inf")) > board[-1]):
+                return None
+            return bisect.bisect_left(board, (-score, float("-inf"))) + 1
+
+
+class ConnectionPool:
+    """SQLite 连接管理器
+    
+    开启 WAL 后读写互不阻塞：读操作从只读连接池中借用连接，
+    所有写操作都经过唯一的写连接，避免多个连接争抢数据库锁。
+    """
+    def __init__(self, db_path=DATABASE, readers: int = READ_POOL_SIZE):
+        self.db_path = db_path
+        self.memory = db_path == ":memory:"
+        self.writer = self._connect()
+        self.writer_lock = threading.Lock()
+        if not self.memory:
+            self.writer.execute('PRAGMA journal_mode=WAL')
+            # 每次提交都同步 WAL，合并写线程的确认即代表已落盘
+            self.writer.execute('PRAGMA synchronous=FULL')
+        
+        # 内存数据库无法被多个连接共享，只读请求直接复用写连接
+        self._readers = queue.Queue()
+        if not self.memory:
+            for _ in range(readers):
+                conn = self._connect()
+                conn.execute('PRAGMA query_only=ON')
+                self._readers.put(conn)
+    
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=DB_BUSY_TIMEOUT)
+        conn.execute(f'PRAGMA busy_timeout={int(DB_BUSY_TIMEOUT * 1000)}')
+        return conn
+    
+    @contextmanager
+    def reader(self):
+        """借用一个只读连接"""
+        if self.memory:
+            with self.writer_lock:
+                yield self.writer
+            return
+        conn = self._readers.get()
+        try:
+            yield conn
+        finally:
+            self._readers.put(conn)
+    
+    @contextmanager
+    def write(self):
+        """独占写连接，正常退出时提交，异常时回滚"""
+        with self.writer_lock:
+            try:
+                yield self.writer
+                self.writer.commit()
+            except Exception:
+                self.writer.rollback()
+                raise
+    
+    def close(self):
+        while not self._readers.empty():
+            self._readers.get_nowait().close()
+        with self.writer_lock:
+            self.writer.close()
+
+
+class GroupCommitWriter:
+    """合并写线程（group commit）
+    
+    各处理器提交的写操作进入队列，由唯一的写线程把多个用户的写入
+    合并进同一个事务：攒够 WRITE_BATCH_SIZE 条或等满 WRITE_BATCH_DELAY
+    秒就提交一次，一次 fsync 确认整批写入。每个操作在独立的 SAVEPOINT
+    中执行，单条失败只回滚它自己。提交成功后才完成对应的 Future。
+    """
+    def __init__(self, pool: ConnectionPool, max_batch: int = WRITE_BATCH_SIZE,
+                 max_delay: float = WRITE_BATCH_DELAY):
+        self.pool = pool
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, name="ef-db-writer", daemon=True)
+        self._thread.start()
+    
+    def submit(self, func, *args, on_commit=None) -> Future:
+        """提交写操作 func(cursor, *args)，返回在事务提交后完成的 Future
+        
+        on_commit(result) 在提交成功后、Future 完成前于写线程中调用。
+        """
+        future = Future()
+        self._queue.put((func, args, on_commit, future))
+        return future
+    
+    # 写线程当前操作登记的提交后回调；每个分片的写线程各自一份
+    _local = threading.local()
+    
+    @classmethod
+    def after_commit(cls, callback):
+        """在操作函数内调用：当前操作所在事务提交后执行 callback()
+        
+        操作失败回滚时登记的回调会被丢弃，用于同步内存镜像。
+        """
+        cls._local.hooks.append(callback)
+    
+    def close(self):
+        self._queue.put(None)
+        self._thread.join()
+    
+    def _run(self):
+        running = True
+        while running:
+            item = self._queue.get()
+            if item is None:
+                break
+            batch = [item]
+            deadline = time.monotonic() + self.max_delay
+            while len(batch) < self.max_batch:
+                try:
+                    # 先取走已排队的写操作，队列空了再短暂等待
+                    item = self._queue.get_nowait()
+                except queue.Empty:
+                    timeout = deadline - time.monotonic()
+                    if timeout <= 0:
+                        break
+                    try:
+                        item = self._queue.get(timeout=timeout)
+                    except queue.Empty:
+                        break
+                if item is None:
+                    running = False
+                    break
+                batch.append(item)
+            self._commit_batch(batch)
+    
+    def _commit_batch(self, batch):
+        started = time.perf_counter() if metrics.sampled() else None
+        metrics.count("ef_db_write_ops_total", "合并写入的写操作数", len(batch))
+        results = []
+        with self.pool.writer_lock:
+            conn = self.pool.writer
+            try:
+                conn.execute('BEGIN IMMEDIATE')
+                cursor = conn.cursor()
+                for func, args, on_commit, future in batch:
+                    hooks = self._local.hooks = []
+                    cursor.execute('SAVEPOINT op')
+                    try:
+                        result = func(cursor, *args)
+                    except Exception as e:
+                        cursor.execute('ROLLBACK TO op')
+                        cursor.execute('RELEASE op')
+                        results.append((future, on_commit, None, e, []))
+                    else:
+                        cursor.execute('RELEASE op')
+                        results.append((future, on_commit, result, None, hooks))
+                conn.commit()
+            except Exception as e:
+                if conn.in_transaction:
+                    conn.rollback()
+                logger.exception("批量写入提交失败（%d 条）", len(batch))
+                metrics.record("db", "group_commit", None, error=True)
+                for func, args, on_commit, future in batch:
+                    future.set_exception(e)
+                return
+        metrics.record("db", "group_commit", None if started is None else time.perf_counter() - started)
+        
+        for future, on_commit, result, error, hooks in results:
+            if error is not None:
+                future.set_exception(error)
+                continue
+            try:
+                for hook in hooks:
+                    hook()
+                if on_commit is not None:
+                    on_commit(result)
+            except Exception:
+                logger.exception("写入提交回调失败")
+            future.set_result(result)
+
+
+class StorageBackend:
+    """存储后端：一组 SQLite 分片，以及按 user_id 选择分片的规则
+    
+    每个分片是一个独立的数据库（各自的连接池和合并写线程），写入在
+    分片之间并行提交。users、checkins、checkin_bitmaps、orders 按
+    user_id 散列到分片；卡密库存、群发任务、机器号租约等全局表只使用
+    0 号分片。所有分片的表结构相同，统计计数器各自记录本分片的数据。
+    """
+    def __init__(self, paths: List[str], readers: int = READ_POOL_SIZE):
+        self.paths = paths
+        self.pools = [ConnectionPool(path, readers) for path in paths]
+        self.writers: List[GroupCommitWriter] = []
+        self._fan_out = ThreadPoolExecutor(max_workers=len(paths), thread_name_prefix="ef-db-shard") \
+            if len(paths) > 1 else None
+    
+    @property
+    def size(self) -> int:
+        return len(self.pools)
+    
+    def start_writers(self):
+        """迁移完成后再启动各分片的写线程"""
+        self.writers = [GroupCommitWriter(pool) for pool in self.pools]
+    
+    def shard_of(self, user_id: int) -> int:
+        if len(self.pools) == 1:
+            return 0
+        # 乘法散列打散相邻的 ID，再取高位
+        return (((user_id * 0x9E3779B97F4A7C15) & 0xFFFFFFFFFFFFFFFF) >> 32) % len(self.pools)
+    
+    def pool_for(self, user_id: int) -> ConnectionPool:
+        return self.pools[self.shard_of(user_id)]
+    
+    def writer_for(self, user_id: int) -> GroupCommitWriter:
+        return self.writers[self.shard_of(user_id)]
+    
+    def fan_out(self, func, *args) -> List:
+        """在每个分片的只读连接上执行 func(conn, *args)，按分片顺序返回结果"""
+        def run(pool):
+            with pool.reader() as conn:
+                return func(conn, *args)
+        
+        if self._fan_out is None:
+            return [run(pool) for pool in self.pools]
+        return list(self._fan_out.map(run, self.pools))
+    
+    def close_writers(self):
+        for writer in self.writers:
+            writer.close()
+    
+    def close(self):
+        if self._fan_out is not None:
+            self._fan_out.shutdown(wait=True)
+        for pool in self.pools:
+            pool.close()
+
+
+class ShardedSQLiteBackend(StorageBackend):
+    """按 user_id 分布到多个 SQLite 文件：0 号分片即 db_path，其余为 name.<i>.db"""
+    def __init__(self, db_path: str = DATABASE, shards: int = DB_SHARDS, readers: int = READ_POOL_SIZE):
+        super().__init__(self.shard_paths(db_path, shards), readers)
+    
+    @staticmethod
+    def shard_paths(db_path: str, shards: int) -> List[str]:
+        root, ext = os.path.splitext(db_path)
+        return [db_path] + [f"{root}.{i}{ext}" for i in range(1, shards)]
+
+
+class MemoryBackend(StorageBackend):
+    """内存数据库后端，用于测试；每个分片是一个独立的内存库"""
+    def __init__(self, shards: int = 1):
+        super().__init__([":memory:"] * shards)
+
+
+def make_backend(db_path: str = DATABASE, shards: int = DB_SHARDS,
+                 readers: int = READ_POOL_SIZE) -> StorageBackend:
+    if db_path == ":memory:":
+        return MemoryBackend(shards)
+    return ShardedSQLiteBackend(db_path, shards, readers)
+
+
 class Database:
-    def __init__(self, db_path=DATABASE):
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
-        self.create_tables()
+    """数据库访问层
+    
+    读方法同步返回结果；写方法交给合并写线程，返回事务提交（落盘）
+    后完成的 concurrent.futures.Future，同步调用方用 .result() 等待。
+    
+    数据存放在 StorageBackend 的分片中：用户相关的读写按 user_id 路由，
+    self.pool / self.writer 指向存放全局表的 0 号分片。
+    """
+    def __init__(self, db_path=DATABASE, readers: int = READ_POOL_SIZE, shards: int = DB_SHARDS,
+                 backend: Optional[StorageBackend] = None):
+        self.backend = backend or make_backend(db_path, shards, readers)
+        self.pool = self.backend.pools[0]
+        try:
+            self.migrate()
+        except Exception:
+            self.backend.close()
+            raise
+        self.backend.start_writers()
+        self.writer = self.backend.writers[0]
+        self.users = UserCache()
+        # 已结束日期的汇总（重建、补记旧订单收入）提交后加一，统计图缓存据此失效；
+        # 当天的数据天天在变，不计入版本
+        self.stats_version = 0
+        self._stats_version_lock = threading.Lock()
+        # 排行榜启动时按索引从各分片取前 N 名，之后随用户记录的提交增量更新
+        self.leaderboard = Leaderboard(self._load_leaderboard)
+        for metric in LEADERBOARD_METRICS:
+            self.leaderboard.reload(metric)
+        # 内存镜像为各分片计数器之和
+        self.counters = StatsCounters()
+        self.counters.replace(self._load_counters())
+        
+        # 订单号机器号：从数据库租用，后台线程定期续约
+        self._lease_owner = f"{socket.gethostname()}:{os.getpid()}:{secrets.token_hex(4)}"
+        started = time.monotonic()
+        self.order_ids = OrderIdGenerator(self._acquire_worker_id())
+        self.order_ids.renewed(started)
+        self._lease_lock = threading.Lock()
+        self._lease_stop = threading.Event()
+        self._lease_thread = threading.Thread(
+            target=self._renew_worker_lease, name="ef-order-lease", daemon=True
+        )
+        self._lease_thread.start()
+    
+    def migrate(self):
+        """对每个分片执行迁移，并核对分片布局与配置一致"""
+        for index, pool in enumerate(self.backend.pools):
+            self._migrate_shard(pool, index)
+            self._check_shard_layout(pool, index)
+    
+    @staticmethod
+    def _migrate_shard(pool: ConnectionPool, index: int):
+        """按版本号依次执行未应用的迁移，已有数据库原地升级"""
+        with pool.write() as conn:
+            conn.execute('''
+                CREATE TABLE IF NOT EXISTS schema_version (
+                    version INTEGER PRIMARY KEY,
+                    description TEXT,
+                    applied_at TEXT DEFAULT CURRENT_TIMESTAMP
+                )
+            ''')
+        
+        for version, description, steps in MIGRATIONS:
+            with pool.write() as conn:
+                # IMMEDIATE 锁住数据库，多个进程同时启动时只有一个执行迁移
+                conn.execute('BEGIN IMMEDIATE')
+                applied = conn.execute(
+                    'SELECT 1 FROM schema_version WHERE version = ?', (version,)
+                ).fetchone()
+                if applied:
+                    continue
+                cursor = conn.cursor()
+                for step in steps:
+                    if callable(step):
+                        step(cursor)
+                    else:
+                        cursor.execute(step)
+                cursor.execute(
+                    'INSERT INTO schema_version (version, description) VALUES (?, ?)',
+                    (version, description)
+                )
+                logger.info("数据库迁移 v%d: %s（分片 %d）", version, description, index)
+    
+    def _check_shard_layout(self, pool: ConnectionPool, index: int):
+        """首次启动时记录分片数和编号；之后配置不一致则拒绝启动，避免用户被路由到错误的分片"""
+        expected = {"shards": str(self.backend.size), "shard_index": str(index)}
+        with pool.write() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            stored = dict(conn.execute('SELECT key, value FROM storage_meta'))
+            if not stored:
+                conn.executemany('INSERT INTO storage_meta (key, value) VALUES (?, ?)', expected.items())
+                return
+        if stored != expected:
+            raise RuntimeError(
+                f"分片布局不一致：{pool.db_path} 记录为 {stored}，当前配置为 {expected}；"
+                f"更改分片数需要先迁移数据"
+            )
+    
+    def close(self):
+        self._lease_stop.set()
+        self._lease_thread.join()
+        self.backend.close_writers()
+        # 正常退出时立即释放机器号，不必等租约过期
+        with self.pool.write() as conn:
+            conn.execute(
+                'DELETE FROM worker_leases WHERE worker_id = ? AND owner = ?',
+                (self.order_ids.worker_id, self._lease_owner)
+            )
+        self.backend.close()
+    
+    # ---------- 订单号机器号租约 ----------
+    def _acquire_worker_id(self) -> int:
+        """租用一个空闲或租约已过期的机器号"""
+        with self.pool.write() as conn:
+            conn.execute('BEGIN IMMEDIATE')
+            now = time.time()
+            leases = dict(conn.execute('SELECT worker_id, heartbeat FROM worker_leases'))
+            for worker_id in range(OrderIdGenerator.MAX_WORKERS):
+                if leases.get(worker_id, 0) < now - ORDER_WORKER_LEASE_TTL:
+                    break
+            else:
+                raise RuntimeError("没有可用的订单机器号")
+            conn.execute(
+                'INSERT OR REPLACE INTO worker_leases (worker_id, owner, heartbeat) VALUES (?, ?, ?)',
+                (worker_id, self._lease_owner, now)
+            )
+        logger.info("订单机器号: %d", worker_id)
+        return worker_id
+    
+    def _renew_worker_lease(self):
+        while not self._lease_stop.wait(ORDER_WORKER_LEASE_TTL / 3):
+            try:
+                self._refresh_worker_lease()
+            except Exception:
+                logger.exception("订单机器号续约失败")
+    
+    def _refresh_worker_lease(self):
+        """续约；租约已被其他进程接管（本进程停顿超过 TTL）时换一个机器号"""
+        with self._lease_lock:
+            started = time.monotonic()
+            renewed = self.writer.submit(
+                self._renew_lease, self.order_ids.worker_id, time.time()
+            ).result()
+            if renewed:
+                self.order_ids.renewed(started)
+                return
+            logger.warning("订单机器号 %d 租约丢失，重新申请", self.order_ids.worker_id)
+            started = time.monotonic()
+            self.order_ids.renewed(started, self._acquire_worker_id())
+    
+    def next_order_no(self) -> str:
+        """生成订单号；租约已过期（续约线程没赶上）时先同步续约"""
+        try:
+            return self.order_ids.next_order_no()
+        except LeaseExpired:
+            self._refresh_worker_lease()
+            return self.order_ids.next_order_no()
+    
+    def _renew_lease(self, cursor, worker_id, now):
+        cursor.execute(
+            'UPDATE worker_leases SET heartbeat = ? WHERE worker_id = ? AND owner = ?',
+            (now, worker_id, self._lease_owner)
+        )
+        return cursor.rowcount == 1
+    
+    def get_user(self, user_id: int) -> Optional[UserRecord]:
+        record = self.users.get(user_id)
+        if record is not None:
+            return record
+        return self.load_user(user_id)
+    
+    def load_user(self, user_id: int) -> Optional[UserRecord]:
+        """跳过缓存直接查库，并把结果回填到缓存"""
+        with self.backend.pool_for(user_id).reader() as conn:
+            row = conn.execute(f'{USER_SELECT} WHERE user_id = ?', (user_id,)).fetchone()
+        if row is None:
+            return None
+        record = UserRecord(row)
+        self.users.put(record, overwrite=False)
+        return record
+    
+    def _cache_user(self, record: Optional[UserRecord]):
+        """用户记录提交后写回缓存并更新排行榜；改动金币/积分的写操作都应经过这里"""
+        if record is not None:
+            self.users.put(record)
+            self.leaderboard.update(
+                record.user_id, {metric: getattr(record, metric) for metric in LEADERBOARD_METRICS}
+            )
+    
+    @staticmethod
+    def _fetch_user(cursor, user_id) -> Optional[UserRecord]:
+        """在写事务内读回最新的用户记录，用于提交后写回缓存"""
+        row = cursor.execute(f'{USER_SELECT} WHERE user_id = ?', (user_id,)).fetchone()
+        return UserRecord(row) if row else None
+    
+    def create_user(self, user_id: int, username: str, first_name: str, last_name: str = "") -> Future:
+        """注册用户，Future 的结果为用户记录"""
+        return self.backend.writer_for(user_id).submit(
+            self._create_user, user_id, username, first_name, last_name,
+            on_commit=self._cache_user
+        )
+    
+    def _create_user(self, cursor, user_id, username, first_name, last_name):
+        cursor.execute('''
+            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, username, first_name, last_name))
+        inserted = cursor.rowcount == 1
+        record = self._fetch_user(cursor, user_id)
+        if inserted:
+            self._bump(cursor, 'users')
+            self._bump(cursor, f'users_day:{local_day(record.created_at)}')
+            self._rollup(cursor, local_day(record.created_at), 'signups')
+            cursor.execute(
+                'INSERT INTO user_search (rowid, username, first_name, last_name) VALUES (?, ?, ?, ?)',
+                (record.id, username, first_name, last_name)
+            )
+        return record
+    
+    def update_checkin(self, user_id: int, coins: int, points: int) -> Future:
+        """签到，Future 的结果为签到后的用户记录；今天已签到过时为 None"""
+        today = datetime.now().strftime("%Y-%m-%d")
+        return self.backend.writer_for(user_id).submit(
+            self._update_checkin, user_id, coins, points, today,
+            on_commit=self._cache_user
+        )
+    
+    def _update_checkin(self, cursor, user_id, coins, points, today):
+        # 更新用户数据；今天已签到的不再更新（调用方的缓存可能没看到其他进程的签到）
+        cursor.execute('''
+            UPDATE users 
+            SET coins = coins + ?, 
+                points = points + ?, 
+                checkin_days = checkin_days + 1,
+                last_checkin = ?
+            WHERE user_id = ? AND (last_checkin IS NULL OR last_checkin <> ?)
+        ''', (coins, points, today, user_id, today))
+        if cursor.rowcount == 0:
+            # 已签到过（或用户不存在）：不发奖励，只刷新缓存
+            self.writer.after_commit(functools.partial(self._cache_user, self._fetch_user(cursor, user_id)))
+            return None
+        
+        # 记录签到
+        cursor.execute('''
+            INSERT INTO checkins (user_id, checkin_date, coins_earned, points_earned)
+            VALUES (?, ?, ?, ?)
+        ''', (user_id, today, coins, points))
+        
+        # 置位当月签到位图
+        cursor.execute('''
+            INSERT INTO checkin_bitmaps (user_id, month, bits) VALUES (?, ?, ?)
+            ON CONFLICT (user_id, month) DO UPDATE SET bits = bits | excluded.bits
+        ''', (user_id, today[:7], 1 << (int(today[8:10]) - 1)))
+        self._rollup(cursor, today, 'checkins')
+        return self._fetch_user(cursor, user_id)
+    
+    def add_order(self, user_id: int, card_type: str, amount: float) -> Future:
+        """创建订单，Future 的结果为订单号"""
+        order_no = self.next_order_no()
+        return self.backend.writer_for(user_id).submit(self._add_order, user_id, order_no, card_type, amount)
+    
+    def _add_order(self, cursor, user_id, order_no, card_type, amount):
+        day = cursor.execute(f'''
+            INSERT INTO orders (user_id, order_no, card_type, amount)
+            VALUES (?, ?, ?, ?)
+            RETURNING {LOCAL_DAY_SQL}
+        ''', (user_id, order_no, card_type, amount)).fetchone()[0]
+        self._bump(cursor, 'orders')
+        self._rollup(cursor, day, 'orders')
+        self._rollup(cursor, day, f'orders:{card_type}')
+        return order_no
+    
+    def find_order(self, order_no: str) -> Optional[Tuple[int, Dict]]:
+        """按订单号查找订单，返回 (分片编号, 订单)；订单号不含用户信息，需要查询所有分片"""
+        columns = ('user_id', 'card_type', 'amount', 'status')
+        rows = self.backend.fan_out(lambda conn: conn.execute(
+            f"SELECT {', '.join(columns)} FROM orders WHERE order_no = ?", (order_no,)
+        ).fetchone())
+        for index, row in enumerate(rows):
+            if row is not None:
+                return index, dict(zip(columns, row))
+        return None
+    
+    def _add_revenue(self, cursor, day, card_type, amount):
+        self._bump(cursor, 'sales', amount)
+        self._rollup(cursor, day, 'revenue', amount)
+        self._rollup(cursor, day, f'revenue:{card_type}', amount)
     
-    def create_tables(self):
-        """创建数据表"""
-        cursor = self.conn.cursor()
+    # ---------- 卡密发放 ----------
+    # 确认收款并发放卡密分三步，各自提交，流程见 AsyncDatabase.dispense_card
+    def mark_paid(self, shard: int, order_no: str) -> Future:
+        """待支付或已过期的订单标记为 paid，Future 的结果为是否有改动"""
+        return self.backend.writers[shard].submit(self._mark_paid, order_no)
+    
+    def claim_card(self, order_no: str, user_id: int, card_type: str) -> Future:
+        """按订单号认领一张卡密，Future 的结果为卡密，库存不足时为 None"""
+        sold_at = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        return self.writer.submit(self._claim_card, order_no, user_id, card_type, sold_at)
+    
+    def complete_order(self, shard: int, order_no: str, user_id: int, amount: float) -> Future:
+        """paid 订单改为 completed，Future 的结果为是否有改动"""
+        return self.backend.writers[shard].submit(self._complete_order, order_no, user_id, amount)
+    
+    def _mark_paid(self, cursor, order_no) -> bool:
+        cursor.execute(
+            "UPDATE orders SET status = 'paid' WHERE order_no = ? AND status IN ('pending', 'expired')",
+            (order_no,)
+        )
+        return cursor.rowcount == 1
+    
+    def sold_card(self, order_no: str) -> Optional[str]:
+        with self.pool.reader() as conn:
+            row = conn.execute('SELECT card_key FROM card_stock WHERE order_no = ?', (order_no,)).fetchone()
+        return row[0] if row else None
+    
+    def _claim_card(self, cursor, order_no, user_id, card_type, sold_at):
+        already = cursor.execute(
+            'SELECT card_key FROM card_stock WHERE order_no = ?', (order_no,)
+        ).fetchone()
+        if already is not None:
+            return already[0]
+        
+        # 单条语句原子地认领一张卡密：只会改动 is_sold = 0 的行，不可能重复售出
+        claimed = cursor.execute('''
+            UPDATE card_stock
+            SET is_sold = 1, sold_to = ?, sold_at = ?, order_no = ?
+            WHERE id = (
+                SELECT id FROM card_stock
+                WHERE card_type = ? AND is_sold = 0
+                ORDER BY id LIMIT 1
+            )
+            RETURNING card_key
+        ''', (user_id, sold_at, order_no, card_type)).fetchone()
+        if claimed is None:
+            return None
+        self._bump(cursor, f'stock:{card_type}', -1)
+        return claimed[0]
+    
+    def _release_cards(self, cursor, order_nos: List[str]) -> int:
+        """把已认领给这些订单的卡密退回库存，返回退回的张数"""
+        released = 0
+        for chunk in iter_chunks(order_nos, 500):
+            rows = cursor.execute(f'''
+                UPDATE card_stock SET is_sold = 0, sold_to = NULL, sold_at = NULL, order_no = NULL
+                WHERE order_no IN ({', '.join('?' * len(chunk))})
+                RETURNING card_type
+            ''', chunk).fetchall()
+            for (card_type,) in rows:
+                self._bump(cursor, f'stock:{card_type}', 1)
+            released += len(rows)
+        return released
+    
+    # ---------- 过期订单 ----------
+    def expire_orders_batch(self, shard: int, cutoff: str, limit: int = ORDER_SWEEP_BATCH) -> Future:
+        """把一个分片中 created_at 早于 cutoff 的待支付订单标记为 expired，每次最多 limit 条
+        
+        Future 的结果为本批过期的订单号。每批是合并写线程里的一个短操作，
+        与正常下单交替提交，不会长时间占用写锁。
+        """
+        return self.backend.writers[shard].submit(self._expire_orders_batch, cutoff, limit)
+    
+    @staticmethod
+    def _expire_orders_batch(cursor, cutoff, limit):
+        rows = cursor.execute('''
+            UPDATE orders SET status = 'expired'
+            WHERE id IN (
+                SELECT id FROM orders
+                WHERE status = 'pending' AND created_at < ?
+                ORDER BY created_at LIMIT ?
+            )
+            RETURNING order_no
+        ''', (cutoff, limit)).fetchall()
+        return [order_no for (order_no,) in rows]
+    
+    def release_cards(self, order_nos: List[str]) -> Future:
+        """退回已认领给这些订单的卡密（认领后订单被取消时使用），Future 的结果为张数"""
+        return self.writer.submit(self._release_cards, order_nos)
+    
+    def _complete_order(self, cursor, order_no, user_id, amount):
+        """paid 订单改为 completed 并累计消费；订单已不是 paid 时返回 False"""
+        row = cursor.execute(
+            "UPDATE orders SET status = 'completed' WHERE order_no = ? AND status = 'paid' "
+            f"RETURNING card_type, {LOCAL_DAY_SQL}",
+            (order_no,)
+        ).fetchone()
+        if row is None:
+            return False
+        card_type, day = row
+        self._add_revenue(cursor, day, card_type, amount)
+        cursor.execute(
+            'UPDATE users SET total_spent = total_spent + ? WHERE user_id = ?', (amount, user_id)
+        )
+        self.writer.after_commit(
+            functools.partial(self._cache_user, self._fetch_user(cursor, user_id))
+        )
+        return True
+    
+    # ---------- 卡密入库 ----------
+    # 以下批量方法会阻塞等待每块写入提交，应在后台线程中调用
+    def generate_cards(self, card_type: str, count: int, price: float,
+                       chunk_size: int = CARD_CHUNK_SIZE) -> Dict:
+        """批量生成卡密，遇到重复的卡密会补生成，直到入库数量达到 count"""
+        inserted = duplicates = 0
+        while inserted < count:
+            keys = [new_card_key() for _ in range(min(chunk_size, count - inserted))]
+            added = self.writer.submit(self._insert_cards, card_type, price, keys).result()
+            inserted += added
+            duplicates += len(keys) - added
+        return {"inserted": inserted, "duplicates": duplicates}
+    
+    def import_cards(self, lines: Iterable[str], card_type: str, price: float,
+                     chunk_size: int = CARD_CHUNK_SIZE) -> Dict:
+        """流式导入卡密（每行一个，忽略空行和 # 注释），已存在的卡密计为重复"""
+        keys = (line.strip() for line in lines)
+        keys = (key for key in keys if key and not key.startswith('#'))
+        inserted = duplicates = 0
+        for chunk in iter_chunks(keys, chunk_size):
+            added = self.writer.submit(self._insert_cards, card_type, price, chunk).result()
+            inserted += added
+            duplicates += len(chunk) - added
+        return {"inserted": inserted, "duplicates": duplicates}
+    
+    def import_card_file(self, path: str, card_type: str, price: float) -> Dict:
+        with open(path, encoding='utf-8-sig', errors='replace') as f:
+            return self.import_cards(f, card_type, price)
+    
+    def _insert_cards(self, cursor, card_type, price, keys):
+        # card_key 有 UNIQUE 约束，重复的卡密被忽略，rowcount 只计入实际插入的行
+        cursor.executemany(
+            'INSERT OR IGNORE INTO card_stock (card_type, card_key, price) VALUES (?, ?, ?)',
+            ((card_type, key, price) for key in keys)
+        )
+        added = cursor.rowcount
+        if added:
+            self._bump(cursor, f'stock:{card_type}', added)
+        return added
+    
+    # ---------- 历史记录 ----------
+    HISTORY_COLUMNS = {
+        "checkins": ('id', 'checkin_date', 'coins_earned', 'points_earned'),
+        "orders": ('id', 'order_no', 'card_type', 'amount', 'status', 'created_at'),
+    }
+    
+    def get_history_page(self, table: str, user_id: int, cursor: Optional[int] = None,
+                         older: bool = True, limit: int = HISTORY_PAGE_SIZE) -> Dict:
+        """按 (user_id, id) keyset 分页读取用户的签到/订单记录，新的在前
+        
+        cursor 为空时取最新一页；older 为真取 id < cursor 的下一页，否则取
+        id > cursor 的上一页。多取一行判断该方向是否还有数据，不使用 OFFSET。
+        """
+        columns = self.HISTORY_COLUMNS[table]
+        sql = f"SELECT {', '.join(columns)} FROM {table} WHERE user_id = ?"
+        if cursor is None:
+            sql += ' ORDER BY id DESC LIMIT ?'
+            params = (user_id, limit + 1)
+        elif older:
+            sql += ' AND id < ? ORDER BY id DESC LIMIT ?'
+            params = (user_id, cursor, limit + 1)
+        else:
+            sql += ' AND id > ? ORDER BY id ASC LIMIT ?'
+            params = (user_id, cursor, limit + 1)
+        
+        with self.backend.pool_for(user_id).reader() as conn:
+            rows = conn.execute(sql, params).fetchall()
+        
+        more = len(rows) > limit
+        rows = rows[:limit]
+        if cursor is not None and not older:
+            rows.reverse()
+            has_newer, has_older = more, True
+        else:
+            has_newer, has_older = cursor is not None, more
+        
+        return {
+            "rows": [dict(zip(columns, row)) for row in rows],
+            "has_newer": has_newer and bool(rows),
+            "has_older": has_older and bool(rows),
+        }
+    
+    # ---------- 数据导出 ----------
+    def table_columns(self, table: str) -> List[str]:
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"不允许导出的表: {table}")
+        with self.pool.reader() as conn:
+            return [d[0] for d in conn.execute(f'SELECT * FROM {table} LIMIT 0').description]
+    
+    def iter_rows(self, table: str, chunk_size: int = EXPORT_CHUNK_SIZE):
+        """逐个分片按主键分块遍历整张表（keyset 分页），每块用完即归还读连接
+        
+        各分片的 id 各自编号，多分片时不同分片的 id 可能重复。
+        """
+        if table not in EXPORT_TABLES:
+            raise ValueError(f"不允许导出的表: {table}")
+        for pool in self.backend.pools:
+            last_id = 0
+            while True:
+                with pool.reader() as conn:
+                    rows = conn.execute(
+                        f'SELECT * FROM {table} WHERE id > ? ORDER BY id LIMIT ?',
+                        (last_id, chunk_size)
+                    ).fetchall()
+                if not rows:
+                    break
+                yield from rows
+                last_id = rows[-1][0]
+    
+    def export_table(self, table: str, path: str, fmt: str = "csv") -> int:
+        """把整张表流式导出为 gzip 压缩的 CSV/JSONL 文件，返回导出行数
+        
+        读取、编码、压缩串成生成器管道，内存占用与表大小无关。
+        """
+        columns = self.table_columns(table)
+        count = 0
+        
+        def counted():
+            nonlocal count
+            for row in self.iter_rows(table):
+                count += 1
+                yield row
+        
+        lines = csv_lines(columns, counted()) if fmt == "csv" else jsonl_lines(columns, counted())
+        with gzip.open(path, 'wt', encoding='utf-8', newline='') as f:
+            for line in lines:
+                f.write(line)
+        return count
+    
+    # ---------- 群发 ----------
+    BROADCAST_COLUMNS = ('id', 'text', 'created_by', 'chat_id', 'status', 'last_user_pk',
+                         'sent', 'failed', 'blocked', 'elapsed')
+    
+    def create_broadcast(self, text: str, created_by: int, chat_id: int) -> Future:
+        """登记群发任务，Future 的结果为任务ID"""
+        return self.writer.submit(self._create_broadcast, text, created_by, chat_id)
+    
+    @staticmethod
+    def _create_broadcast(cursor, text, created_by, chat_id):
+        cursor.execute(
+            'INSERT INTO broadcasts (text, created_by, chat_id) VALUES (?, ?, ?)',
+            (text, created_by, chat_id)
+        )
+        return cursor.lastrowid
+    
+    def get_broadcasts(self, status: Optional[str] = None) -> List[Dict]:
+        sql = f"SELECT {', '.join(self.BROADCAST_COLUMNS)} FROM broadcasts"
+        params = ()
+        if status is not None:
+            sql += ' WHERE status = ?'
+            params = (status,)
+        with self.pool.reader() as conn:
+            rows = conn.execute(sql + ' ORDER BY id', params).fetchall()
+        return [dict(zip(self.BROADCAST_COLUMNS, row)) for row in rows]
+    
+    def save_broadcast_progress(self, broadcast_id: int, last_user_pk: int, sent: int,
+                                failed: int, blocked: int, elapsed: float,
+                                status: str = 'running') -> Future:
+        """保存群发进度；状态变为 running 以外时同时记录结束时间"""
+        return self.writer.submit(
+            self._save_broadcast_progress, broadcast_id, last_user_pk, sent,
+            failed, blocked, elapsed, status
+        )
+    
+    @staticmethod
+    def _save_broadcast_progress(cursor, broadcast_id, last_user_pk, sent, failed, blocked,
+                                 elapsed, status):
+        cursor.execute('''
+            UPDATE broadcasts
+            SET last_user_pk = ?, sent = ?, failed = ?, blocked = ?, elapsed = ?, status = ?,
+                finished_at = CASE WHEN ? = 'running' THEN NULL ELSE CURRENT_TIMESTAMP END
+            WHERE id = ? AND status = 'running'
+        ''', (last_user_pk, sent, failed, blocked, elapsed, status, status, broadcast_id))
+        return cursor.rowcount == 1
+    
+    def cancel_broadcast(self, broadcast_id: int) -> Future:
+        return self.writer.submit(self._cancel_broadcast, broadcast_id)
+    
+    @staticmethod
+    def _cancel_broadcast(cursor, broadcast_id):
+        cursor.execute(
+            "UPDATE broadcasts SET status = 'cancelled', finished_at = CURRENT_TIMESTAMP "
+            "WHERE id = ? AND status = 'running'",
+            (broadcast_id,)
+        )
+        return cursor.rowcount == 1
+    
+    # 群发游标 = 分片编号 << RECIPIENT_SHARD_SHIFT | 分片内的 users.id，单分片时就是 users.id
+    RECIPIENT_SHARD_SHIFT = 40
+    
+    def get_recipients(self, after_pk: int, limit: int) -> List[Tuple[int, int]]:
+        """按 (分片, 主键) keyset 分页读取接收人 (游标, user_id)，一个分片读完接着读下一个"""
+        shift = self.RECIPIENT_SHARD_SHIFT
+        shard, last_id = after_pk >> shift, after_pk & ((1 << shift) - 1)
+        page = []
+        while shard < self.backend.size and len(page) < limit:
+            with self.backend.pools[shard].reader() as conn:
+                rows = conn.execute(
+                    'SELECT id, user_id FROM users WHERE id > ? ORDER BY id LIMIT ?',
+                    (last_id, limit - len(page))
+                ).fetchall()
+            page += [(shard << shift | pk, user_id) for pk, user_id in rows]
+            shard, last_id = shard + 1, 0
+        return page
+    
+    # ---------- 用户管理 ----------
+    USER_LIST_COLUMNS = ('id', 'user_id', 'username', 'first_name', 'last_name', 'created_at')
+    
+    def get_user_page(self, before: Optional[int] = None, limit: int = USER_PAGE_SIZE) -> Dict:
+        """按 (分片, 主键) keyset 分页列出用户，分片内新的在前
+        
+        游标编码与群发相同（见 RECIPIENT_SHARD_SHIFT），为本页最后一行；
+        before 为空时从分片 0 的最新用户开始。多取一行判断是否还有下一页。
+        """
+        shift = self.RECIPIENT_SHARD_SHIFT
+        if before is None:
+            shard, last_id = 0, None
+        else:
+            shard, last_id = before >> shift, before & ((1 << shift) - 1)
+        columns = ', '.join(self.USER_LIST_COLUMNS)
+        rows = []
+        while shard < self.backend.size and len(rows) <= limit:
+            sql = f'SELECT {columns} FROM users'
+            params: tuple = ()
+            if last_id is not None:
+                sql += ' WHERE id < ?'
+                params = (last_id,)
+            with self.backend.pools[shard].reader() as conn:
+                found = conn.execute(f'{sql} ORDER BY id DESC LIMIT ?', params + (limit + 1 - len(rows),)).fetchall()
+            rows += [(shard << shift | row[0],) + row[1:] for row in found]
+            shard, last_id = shard + 1, None
+        return {
+            "rows": [dict(zip(self.USER_LIST_COLUMNS, row)) for row in rows[:limit]],
+            "has_more": len(rows) > limit,
+        }
+    
+    def search_users(self, keyword: str, limit: int = USER_PAGE_SIZE) -> List[Dict]:
+        """按用户名/姓名子串搜索（FTS5 trigram 索引），各分片取最新的 limit 个再合并
+        
+        关键词为纯数字时同时按 user_id 精确查找。
+        """
+        keyword = keyword.strip().lstrip('@')
+        found: Dict[int, Dict] = {}
+        if keyword.isdigit():
+            record = self.load_user(int(keyword))
+            if record is not None:
+                found[record.user_id] = {name: getattr(record, name) for name in self.USER_LIST_COLUMNS}
+        if len(keyword) >= USER_SEARCH_MIN_LENGTH:
+            columns = ', '.join(f'u.{name}' for name in self.USER_LIST_COLUMNS)
+            phrase = '"' + keyword.replace('"', '""') + '"'
+            for rows in self.backend.fan_out(lambda conn: conn.execute(f'''
+                SELECT {columns} FROM user_search s JOIN users u ON u.id = s.rowid
+                WHERE user_search MATCH ? ORDER BY s.rowid DESC LIMIT ?
+            ''', (phrase, limit)).fetchall()):
+                for row in rows:
+                    found.setdefault(row[1], dict(zip(self.USER_LIST_COLUMNS, row)))
+        results = sorted(found.values(), key=lambda r: (r["created_at"] or "", r["user_id"]), reverse=True)
+        return results[:limit]
+    
+    # ---------- 排行榜 ----------
+    def _load_leaderboard(self, metric: str, limit: int) -> Tuple[List[Tuple[float, int]], bool]:
+        """各分片按索引取前 limit 名后合并；任一分片取满说明还有榜外用户"""
+        if metric not in LEADERBOARD_METRICS:
+            raise ValueError(f"未知的排行指标: {metric}")
+        per_shard = self.backend.fan_out(lambda conn: conn.execute(
+            f'SELECT {metric}, user_id FROM users ORDER BY {metric} DESC, user_id DESC LIMIT ?', (limit,)
+        ).fetchall())
+        rows = sorted((row for rows in per_shard for row in rows), reverse=True)
+        truncated = len(rows) > limit or any(len(found) == limit for found in per_shard)
+        return rows[:limit], truncated
+    
+    def get_rank(self, metric: str, user_id: int) -> Optional[Dict]:
+        """用户在某指标上的分数与名次（同分同名次）；不在榜内时按索引统计各分片中更高分的人数"""
+        if metric not in LEADERBOARD_METRICS:
+            raise ValueError(f"未知的排行指标: {metric}")
+        record = self.users.get(user_id) or self.load_user(user_id)
+        if record is None:
+            return None
+        score = getattr(record, metric)
+        rank = self.leaderboard.rank_in_board(metric, score)
+        if rank is None:
+            rank = 1 + sum(self.backend.fan_out(lambda conn: conn.execute(
+                f'SELECT COUNT(*) FROM users WHERE {metric} > ?', (score,)
+            ).fetchone()[0]))
+        return {"score": score, "rank": rank}
+    
+    # ---------- 会话状态 ----------
+    def load_user_state(self, user_id: int) -> Optional[bytes]:
+        with self.backend.pool_for(user_id).reader() as conn:
+            row = conn.execute('SELECT data FROM user_state WHERE user_id = ?', (user_id,)).fetchone()
+        return row[0] if row else None
+    
+    def save_user_state(self, user_id: int, data: Optional[bytes]) -> Future:
+        """保存用户的会话状态，data 为空时删除"""
+        return self.backend.writer_for(user_id).submit(self._save_user_state, user_id, data)
+    
+    @staticmethod
+    def _save_user_state(cursor, user_id, data):
+        if data is None:
+            cursor.execute('DELETE FROM user_state WHERE user_id = ?', (user_id,))
+        else:
+            cursor.execute('''
+                INSERT INTO user_state (user_id, data) VALUES (?, ?)
+                ON CONFLICT (user_id) DO UPDATE SET data = excluded.data, updated_at = CURRENT_TIMESTAMP
+            ''', (user_id, data))
+    
+    def load_conversations(self, name: str) -> List[Tuple[str, bytes]]:
+        with self.pool.reader() as conn:
+            return conn.execute('SELECT key, state FROM conversations WHERE name = ?', (name,)).fetchall()
+    
+    def save_conversation(self, name: str, key: str, state: Optional[bytes]) -> Future:
+        """保存对话状态，state 为空表示对话已结束"""
+        return self.writer.submit(self._save_conversation, name, key, state)
+    
+    @staticmethod
+    def _save_conversation(cursor, name, key, state):
+        if state is None:
+            cursor.execute('DELETE FROM conversations WHERE name = ? AND key = ?', (name, key))
+        else:
+            cursor.execute(
+                'INSERT OR REPLACE INTO conversations (name, key, state) VALUES (?, ?, ?)',
+                (name, key, state)
+            )
+    
+    # ---------- 统计计数器 ----------
+    def _bump(self, cursor, name: str, delta: float = 1):
+        """在当前写事务中累加计数器，提交后同步到内存镜像"""
+        cursor.execute('''
+            INSERT INTO stats_counters (name, value) VALUES (?, ?)
+            ON CONFLICT (name) DO UPDATE SET value = value + excluded.value
+        ''', (name, delta))
+        self.writer.after_commit(functools.partial(self.counters.add, name, delta))
+    
+    def _load_counters(self) -> Dict[str, float]:
+        totals: Dict[str, float] = {}
+        for rows in self.backend.fan_out(lambda conn: conn.execute('SELECT name, value FROM stats_counters').fetchall()):
+            for name, value in rows:
+                totals[name] = totals.get(name, 0) + value
+        return totals
+    
+    def resync_mirrors(self):
+        """从数据库重新载入计数器和排行榜
+        
+        内存镜像只随本进程的提交更新，多个进程共用数据库时需要定期同步。
+        与本进程同时提交的写入可能被计两次或漏计，下一次同步时纠正。
+        """
+        self.counters.replace(self._load_counters())
+        for metric in LEADERBOARD_METRICS:
+            self.leaderboard.reload(metric)
+    
+    def recount_counters(self) -> Dict:
+        """从原始数据校对各分片的计数器和按日汇总，返回 {计数器: (原值, 重算值)} 的差异（各分片之和）
+        
+        全表扫描在只读连接上进行，写线程只应用差值，不会被扫描阻塞；
+        扫描期间的并发写入照常累加，不会被覆盖。
+        """
+        old, new = {}, {}
+        futures = []
+        for shard, (stored, fresh, stored_daily, fresh_daily) in enumerate(
+                self.backend.fan_out(self._recount_snapshot)):
+            counter_deltas = {
+                name: fresh.get(name, 0) - stored.get(name, 0)
+                for name in set(stored) | set(fresh)
+            }
+            daily_deltas = {
+                key: fresh_daily.get(key, 0) - stored_daily.get(key, 0)
+                for key in set(stored_daily) | set(fresh_daily)
+            }
+            futures.append(self.backend.writers[shard].submit(
+                self._apply_recount,
+                {name: delta for name, delta in counter_deltas.items() if delta},
+                {key: delta for key, delta in daily_deltas.items() if delta},
+            ))
+            for name, value in stored.items():
+                old[name] = old.get(name, 0) + value
+            for name, value in fresh.items():
+                new[name] = new.get(name, 0) + value
+        for future in futures:
+            future.result()
+        return {
+            name: (old.get(name, 0), new.get(name, 0))
+            for name in sorted(set(old) | set(new))
+            if abs(old.get(name, 0) - new.get(name, 0)) > 1e-6
+        }
+    
+    @staticmethod
+    def _recount_snapshot(conn):
+        # 同一读事务内读取存量和重算值，保证两者对应同一快照
+        conn.execute('BEGIN')
+        try:
+            stored = dict(conn.execute('SELECT name, value FROM stats_counters'))
+            fresh = {}
+            for sql in COUNTER_QUERIES:
+                fresh.update(conn.execute(sql))
+            stored_daily = {
+                (day, metric): value
+                for day, metric, value in conn.execute('SELECT day, metric, value FROM daily_stats')
+            }
+            fresh_daily = {}
+            for sql in DAILY_STATS_QUERIES:
+                fresh_daily.update(((day, metric), value) for day, metric, value in conn.execute(sql))
+            return stored, fresh, stored_daily, fresh_daily
+        finally:
+            conn.rollback()
+    
+    def _apply_recount(self, cursor, counter_deltas: Dict[str, float], daily_deltas: Dict[Tuple[str, str], float]):
+        for name, delta in counter_deltas.items():
+            self._bump(cursor, name, delta)
+        for (day, metric), delta in daily_deltas.items():
+            self._rollup(cursor, day, metric, delta)
+    
+    # ---------- 按日汇总 ----------
+    def _rollup(self, cursor, day: str, metric: str, delta: float = 1):
+        """在当前写事务中累加某天的汇总值"""
+        cursor.execute('''
+            INSERT INTO daily_stats (day, metric, value) VALUES (?, ?, ?)
+            ON CONFLICT (day, metric) DO UPDATE SET value = value + excluded.value
+        ''', (day, metric, delta))
+        if day < datetime.now().strftime("%Y-%m-%d"):
+            self.writer.after_commit(self._touch_stats)
+    
+    def _touch_stats(self):
+        # 各分片的写线程都会调用
+        with self._stats_version_lock:
+            self.stats_version += 1
+    
+    def get_daily_stats(self, since: str) -> Dict[str, Dict[str, float]]:
+        """since（含）以来的按日汇总，合并各分片：{指标: {日期: 值}}"""
+        merged: Dict[str, Dict[str, float]] = {}
+        for rows in self.backend.fan_out(lambda conn: conn.execute(
+            'SELECT day, metric, value FROM daily_stats WHERE day >= ?', (since,)
+        ).fetchall()):
+            for day, metric, value in rows:
+                series = merged.setdefault(metric, {})
+                series[day] = series.get(day, 0) + value
+        return merged
+    
+    # ---------- 签到位图 ----------
+    @staticmethod
+    def _month_bits(conn, user_id: int, month: str) -> int:
+        row = conn.execute(
+            'SELECT bits FROM checkin_bitmaps WHERE user_id = ? AND month = ?', (user_id, month)
+        ).fetchone()
+        return row[0] if row else 0
+    
+    def get_checkin_summary(self, user_id: int, today: date) -> Dict:
+        """签到概况：今日是否已签、当前连续天数、本月签到天数
+        
+        连续天数从今天（未签则从昨天）往前数，每个月只需一次位运算，
+        跨月时才读取上个月的位图。
+        """
+        with self.backend.pool_for(user_id).reader() as conn:
+            bits = self._month_bits(conn, user_id, today.strftime("%Y-%m"))
+            checked_today = bool(bits >> (today.day - 1) & 1)
+            
+            end = today if checked_today else today - timedelta(days=1)
+            month_bits = bits if end.month == today.month else None
+            streak = 0
+            while True:
+                if month_bits is None:
+                    month_bits = self._month_bits(conn, user_id, end.strftime("%Y-%m"))
+                run = run_length_ending(month_bits, end.day)
+                streak += run
+                if run < end.day:
+                    break
+                # 整月全勤，继续数上个月
+                end = end.replace(day=1) - timedelta(days=1)
+                month_bits = None
+        
+        return {
+            "checked_today": checked_today,
+            "streak": streak,
+            "month_count": bin(bits).count("1"),
+        }
+    
+    def get_admin_stats(self, today: str) -> Dict:
+        """管理面板统计数据（读内存计数器，O(1)）"""
+        counters = self.counters.snapshot()
+        return {
+            "total_users": int(counters.get('users', 0)),
+            "today_users": int(counters.get(f'users_day:{today}', 0)),
+            "total_orders": int(counters.get('orders', 0)),
+            "total_sales": counters.get('sales', 0),
+            "stock": {
+                name[len('stock:'):]: int(value)
+                for name, value in counters.items() if name.startswith('stock:')
+            },
+        }
+
+
+class AsyncDatabase:
+    """Database 的异步封装
+    
+    所有 SQLite 调用都放到专用线程池里执行，处理器只 await 结果，
+    慢查询不会再卡住整个事件循环。读请求分散到多个读线程；
+    写请求交给合并写线程，await 返回时事务已经提交。
+    """
+    def __init__(self, db: Database, readers: int = READ_POOL_SIZE):
+        self.db = db
+        # 每个分片各有 readers 个只读连接
+        self.read_executor = ThreadPoolExecutor(
+            max_workers=readers * db.backend.size, thread_name_prefix="ef-db-read"
+        )
+        # 批量任务（生成/导入卡密等）单独排队，不占用读线程
+        self.bulk_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="ef-db-bulk")
+    
+    async def _read(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await metrics.timed("db", func.__name__, loop.run_in_executor(
+            self.read_executor, functools.partial(func, *args, **kwargs)
+        ))
+    
+    async def _write(self, func, *args, **kwargs):
+        # 耗时包含排队和所在批次的提交
+        return await metrics.timed("db", func.__name__, asyncio.wrap_future(func(*args, **kwargs)))
+    
+    async def _bulk(self, func, *args, **kwargs):
+        loop = asyncio.get_running_loop()
+        return await metrics.timed("db", func.__name__, loop.run_in_executor(
+            self.bulk_executor, functools.partial(func, *args, **kwargs)
+        ))
+    
+    async def get_user(self, user_id: int) -> Optional[UserRecord]:
+        # 缓存命中直接返回，不经过线程池
+        record = self.db.users.get(user_id)
+        if record is not None:
+            return record
+        return await self._read(self.db.load_user, user_id)
+    
+    async def create_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
+        return await self._write(self.db.create_user, user_id, username, first_name, last_name)
+    
+    async def update_checkin(self, user_id: int, coins: int, points: int):
+        return await self._write(self.db.update_checkin, user_id, coins, points)
+    
+    async def add_order(self, user_id: int, card_type: str, amount: float) -> str:
+        return await self._write(self.db.add_order, user_id, card_type, amount)
+    
+    async def get_checkin_summary(self, user_id: int, today: date) -> Dict:
+        return await self._read(self.db.get_checkin_summary, user_id, today)
+    
+    async def dispense_card(self, order_no: str) -> Dict:
+        """确认订单并发放卡密
+        
+        返回 dict，status 取值：
+        ok（已发放）、done（此前已发放）、not_found、not_pending、out_of_stock。
+        
+        管理员确认即代表已收款，待支付和已过期的订单都可以确认。订单先标记
+        为 paid（过期清理只处理 pending，不会再动它），再按订单号认领卡密
+        （同一订单重复认领得到同一张），最后改为 completed。订单在用户所在
+        分片，卡密库存在 0 号分片，各步分别提交：中途中断或库存不足时订单
+        停在 paid，重新确认即可继续；订单已被取消则退回卡密。
         
-        # 用户表
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS users (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER UNIQUE,
-                username TEXT,
-                first_name TEXT,
-                last_name TEXT,
-                coins INTEGER DEFAULT 0,
-                points INTEGER DEFAULT 0,
-                total_spent REAL DEFAULT 0.0,
-                checkin_days INTEGER DEFAULT 0,
-                last_checkin TEXT,
-                is_vip INTEGER DEFAULT 0,
-                vip_expiry TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        各步在事件循环里等待写线程提交，不占用读线程池。
+        """
+        found = await self._read(self.db.find_order, order_no)
+        if found is None:
+            return {"status": "not_found", "order_no": order_no}
+        shard, order = found
+        result = dict(order, order_no=order_no)
+        del result["status"]
         
-        # 签到记录
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS checkins (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                checkin_date TEXT,
-                coins_earned INTEGER,
-                points_earned INTEGER,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
+        if order["status"] == 'completed':
+            return dict(result, status="done", card_key=await self._read(self.db.sold_card, order_no))
+        if order["status"] not in ('pending', 'expired', 'paid'):
+            return dict(result, status="not_pending")
+        if order["status"] != 'paid' and not await self._write(self.db.mark_paid, shard, order_no):
+            # 期间被并发确认或取消，按最新状态重新处理
+            return await self.dispense_card(order_no)
         
-        # 订单记录
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS orders (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                user_id INTEGER,
-                order_no TEXT UNIQUE,
-                card_type TEXT,
-                amount REAL,
-                status TEXT DEFAULT 'pending',
-                payment_info TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP,
-                FOREIGN KEY (user_id) REFERENCES users (user_id)
-            )
-        ''')
+        card_key = await self._write(self.db.claim_card, order_no, order["user_id"], order["card_type"])
+        if card_key is None:
+            return dict(result, status="out_of_stock")
         
-        # 卡密库存
-        cursor.execute('''
-            CREATE TABLE IF NOT EXISTS card_stock (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
-                card_type TEXT,
-                card_key TEXT UNIQUE,
-                price REAL,
-                is_sold INTEGER DEFAULT 0,
-                sold_to INTEGER,
-                sold_at TEXT,
-                created_at TEXT DEFAULT CURRENT_TIMESTAMP
-            )
-        ''')
+        if await self._write(self.db.complete_order, shard, order_no, order["user_id"], order["amount"]):
+            return dict(result, status="ok", card_key=card_key)
         
-        self.conn.commit()
+        # 认领期间订单状态变了：被并发确认则卡密相同，被取消则退回库存
+        found = await self._read(self.db.find_order, order_no)
+        if found is not None and found[1]["status"] == 'completed':
+            return dict(result, status="done", card_key=card_key)
+        await self._write(self.db.release_cards, [order_no])
+        return dict(result, status="not_pending")
     
-    def get_user(self, user_id: int):
-        cursor = self.conn.cursor()
-        cursor.execute('SELECT * FROM users WHERE user_id = ?', (user_id,))
-        return cursor.fetchone()
+    async def generate_cards(self, card_type: str, count: int, price: float) -> Dict:
+        return await self._bulk(self.db.generate_cards, card_type, count, price)
     
-    def create_user(self, user_id: int, username: str, first_name: str, last_name: str = ""):
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT OR IGNORE INTO users (user_id, username, first_name, last_name)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, username, first_name, last_name))
-        self.conn.commit()
+    async def import_card_file(self, path: str, card_type: str, price: float) -> Dict:
+        return await self._bulk(self.db.import_card_file, path, card_type, price)
     
-    def update_checkin(self, user_id: int, coins: int, points: int):
-        today = datetime.now().strftime("%Y-%m-%d")
-        cursor = self.conn.cursor()
-        
-        # 更新用户数据
-        cursor.execute('''
-            UPDATE users 
-            SET coins = coins + ?, 
-                points = points + ?, 
-                checkin_days = checkin_days + 1,
-                last_checkin = ?
-            WHERE user_id = ?
-        ''', (coins, points, today, user_id))
-        
-        # 记录签到
-        cursor.execute('''
-            INSERT INTO checkins (user_id, checkin_date, coins_earned, points_earned)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, today, coins, points))
-        
-        self.conn.commit()
+    async def get_history_page(self, table: str, user_id: int, cursor: Optional[int] = None,
+                               older: bool = True) -> Dict:
+        return await self._read(self.db.get_history_page, table, user_id, cursor, older)
+    
+    async def export_table(self, table: str, path: str, fmt: str = "csv") -> int:
+        return await self._bulk(self.db.export_table, table, path, fmt)
     
-    def add_order(self, user_id: int, card_type: str, amount: float):
-        import random
-        import string
+    async def create_broadcast(self, text: str, created_by: int, chat_id: int) -> int:
+        return await self._write(self.db.create_broadcast, text, created_by, chat_id)
+    
+    async def get_broadcasts(self, status: Optional[str] = None) -> List[Dict]:
+        return await self._read(self.db.get_broadcasts, status)
+    
+    async def save_broadcast_progress(self, broadcast_id: int, last_user_pk: int, sent: int,
+                                      failed: int, blocked: int, elapsed: float,
+                                      status: str = 'running') -> bool:
+        return await self._write(
+            self.db.save_broadcast_progress, broadcast_id, last_user_pk, sent,
+            failed, blocked, elapsed, status
+        )
+    
+    async def cancel_broadcast(self, broadcast_id: int) -> bool:
+        return await self._write(self.db.cancel_broadcast, broadcast_id)
+    
+    async def get_recipients(self, after_pk: int, limit: int) -> List[Tuple[int, int]]:
+        return await self._read(self.db.get_recipients, after_pk, limit)
+    
+    async def expire_orders(self, ttl: float = ORDER_TTL, batch: int = ORDER_SWEEP_BATCH) -> Dict:
+        """逐个分片分批过期超时的待支付订单
         
-        order_no = ''.join(random.choices(string.digits, k=10))
-        cursor = self.conn.cursor()
-        cursor.execute('''
-            INSERT INTO orders (user_id, order_no, card_type, amount)
-            VALUES (?, ?, ?, ?)
-        ''', (user_id, order_no, card_type, amount))
-        self.conn.commit()
-        return order_no
+        卡密只在订单标记为 paid 之后才认领，待支付订单不会持有卡密，无需退回。
+        """
+        # created_at 由 CURRENT_TIMESTAMP 写入，是 UTC 时间
+        cutoff = time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(time.time() - ttl))
+        expired = batches = 0
+        for shard in range(self.db.backend.size):
+            while True:
+                order_nos = await self._write(self.db.expire_orders_batch, shard, cutoff, batch)
+                batches += 1
+                expired += len(order_nos)
+                if len(order_nos) < batch:
+                    break
+        return {"expired": expired, "batches": batches}
+    
+    async def get_leaderboard(self, metric: str) -> List[Tuple[float, int]]:
+        return await self._read(self.db.leaderboard.top, metric)
+    
+    async def get_rank(self, metric: str, user_id: int) -> Optional[Dict]:
+        return await self._read(self.db.get_rank, metric, user_id)
+    
+    async def get_user_page(self, before: Optional[int] = None) -> Dict:
+        return await self._read(self.db.get_user_page, before)
+    
+    async def search_users(self, keyword: str) -> List[Dict]:
+        return await self._read(self.db.search_users, keyword)
+    
+    async def load_user_state(self, user_id: int) -> Optional[bytes]:
+        return await self._read(self.db.load_user_state, user_id)
+    
+    async def save_user_state(self, user_id: int, data: Optional[bytes]):
+        return await self._write(self.db.save_user_state, user_id, data)
+    
+    async def load_conversations(self, name: str) -> List[Tuple[str, bytes]]:
+        return await self._read(self.db.load_conversations, name)
+    
+    async def save_conversation(self, name: str, key: str, state: Optional[bytes]):
+        return await self._write(self.db.save_conversation, name, key, state)
+    
+    async def get_daily_stats(self, since: str) -> Dict[str, Dict[str, float]]:
+        return await self._read(self.db.get_daily_stats, since)
+    
+    async def get_admin_stats(self, today: str) -> Dict:
+        # 计数器在内存中，无需经过线程池
+        return self.db.get_admin_stats(today)
+    
+    async def recount_counters(self) -> Dict:
+        return await self._bulk(self.db.recount_counters)
+    
+    async def resync_mirrors(self):
+        return await self._read(self.db.resync_mirrors)
+    
+    def close(self):
+        self.read_executor.shutdown(wait=True)
+        self.bulk_executor.shutdown(wait=True)
+        self.db.close()
 
 # ==================== 业务逻辑 ====================
 class EFBotService:
-    def __init__(self):
-        self.db = Database()
-        self.price_list = self._get_price_data()
+    def __init__(self, db: Optional[Database] = None):
+        self.db = db or Database()
+        self.screens: Dict[Tuple[str, bool], Tuple[str, InlineKeyboardMarkup]] = {}
+        self.set_price_data(self._get_price_data())
     
     def _get_price_data(self) -> Dict:
         """获取价格数据"""
@@ -184,56 +2214,57 @@ class EFBotService:
         }
     
     def format_price_message(self) -> str:
-        """格式化价格消息"""
+        """格式化价格消息（MarkdownV2，价格数据中的 . - 等字符在这里转义）"""
         price = self.price_list
+        md = functools.partial(escape_markdown, version=2)
         
         message = "💰 *EndlessFlint 价格表*\n\n"
         
         # 卡密价格
         message += "*卡密类：*\n"
         for key, card in price["cards"].items():
-            message += f"• {card['name']}: {card['price']}元 - {card['desc']}\n"
+            message += md(f"• {card['name']}: {card['price']}元 - {card['desc']}") + "\n"
         
         message += "\n*代理类（赠永久卡）：*\n"
         for key, agent in price["agents"].items():
-            message += f"• {agent['name']}: {agent['price']}元 - {agent['desc']}\n"
+            message += md(f"• {agent['name']}: {agent['price']}元 - {agent['desc']}") + "\n"
         
         message += "\n*代理提卡价：*\n"
         for agent_type, prices in price["agent_prices"].items():
             agent_name = price["agents"][agent_type]["name"]
-            message += f"\n{agent_name}：\n"
+            message += f"\n{md(agent_name)}：\n"
             for card_type, price_val in prices.items():
                 card_name = price["cards"][card_type]["name"]
-                message += f"  {card_name}: {price_val}元\n"
+                message += md(f"  {card_name}: {price_val}元") + "\n"
         
         message += "\n⚠️ *注意事项：*\n"
-        message += "1. 代理类仅限\"韩羽\"购买\n"
-        message += "2. 最终所有权归EF所有\n"
-        message += "3. 购买前请确认需求\n"
-        message += "4. 联系客服获取购买链接\n\n"
+        message += md("1. 代理类仅限\"韩羽\"购买\n"
+                      "2. 最终所有权归EF所有\n"
+                      "3. 购买前请确认需求\n"
+                      "4. 联系客服获取购买链接\n\n")
         message += "👨‍💼 客服QQ: 751440488"
         
         return message
     
     def format_help_message(self) -> str:
-        """格式化帮助消息"""
+        """格式化帮助消息（MarkdownV2，已转义）"""
         return """🆘 *EF 帮助中心*
 
 *客服联系方式：*
 📞 QQ: 751440488
-⏰ 工作时间: 9:00-23:00
+⏰ 工作时间: 9:00\\-23:00
 
 *常见问题：*
-1. *如何购买卡密？*
+1\\. *如何购买卡密？*
    联系客服获取购买链接
 
-2. *卡密如何使用？*
+2\\. *卡密如何使用？*
    购买后客服会提供详细教程
 
-3. *代理有什么权限？*
+3\\. *代理有什么权限？*
    请联系客服了解详细代理政策
 
-4. *遇到问题怎么办？*
+4\\. *遇到问题怎么办？*
    添加客服QQ详细说明问题
 
 *温馨提示：*
@@ -244,43 +2275,60 @@ class EFBotService:
 *官方声明：*
 本机器人仅提供信息查询服务
 最终解释权归EF所有"""
-
-# ==================== 处理器 ====================
-class EFBotHandlers:
-    def __init__(self):
-        self.service = EFBotService()
-        self.db = Database()
     
-    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理 /start 命令"""
-        user = update.effective_user
-        
-        # 保存用户信息
-        self.db.create_user(
-            user_id=user.id,
-            username=user.username,
-            first_name=user.first_name,
-            last_name=user.last_name or ""
-        )
-        
-        welcome_text = f"""
-🤖 *欢迎使用 EF 用户帮助机器人*
+    def format_contact_message(self) -> str:
+        """格式化客服联系消息"""
+        return """📞 联系客服
 
-👋 你好 {user.mention_markdown_v2()}！
-
-我们为您提供专业的卡密服务和代理咨询。
-
-📋 *主要功能：*
-• 卡密价格查询
-• 代理政策咨询
-• 用户账户管理
-• 在线客服支持
+客服QQ: 751440488
+工作时间: 9:00-23:00
 
-💡 *快速操作：*
-使用下方按钮或发送命令
-"""
+购买、代理咨询、订单问题请直接添加客服QQ，
+并附上订单号或问题截图，方便快速处理。"""
+    
+    def format_agent_message(self) -> str:
+        """格式化代理政策消息"""
+        price = self.price_list
+        message = "📋 代理政策\n\n"
+        for agent_type, agent in price["agents"].items():
+            message += f"{agent['name']}: {agent['price']:g}元（{agent['desc']}）\n"
+            prices = price["agent_prices"].get(agent_type, {})
+            message += "  提卡价: " + "，".join(
+                f"{price['cards'][card_type]['name']} {price_val:g}元"
+                for card_type, price_val in prices.items()
+            ) + "\n"
+        message += "\n代理类仅限\"韩羽\"购买，详细政策请联系客服QQ: 751440488"
+        return message
+    
+    # ---------- 静态界面渲染缓存 ----------
+    def set_price_data(self, price_list: Dict):
+        """更新价格数据，并重建依赖价格的界面缓存"""
+        self.price_list = price_list
+        self.render_screens()
+    
+    def render_screens(self):
+        """预先渲染所有静态界面，按 (界面, 是否管理员) 缓存文本和键盘"""
+        price_screen = (self.format_price_message(), self._build_price_keyboard())
+        buy_menu = ("🛒 *选择购买项目*\n\n请选择您要购买的商品：", self._build_buy_menu_keyboard())
+        help_screen = (self.format_help_message(), self._build_help_keyboard())
+        contact_screen = (self.format_contact_message(), self._build_back_keyboard("back_to_main"))
+        agent_screen = (self.format_agent_message(), self._build_agent_keyboard())
         
-        # 创建主菜单键盘
+        screens = {}
+        for is_admin in (False, True):
+            screens[("main", is_admin)] = (WELCOME_TEMPLATE, self._build_main_keyboard(is_admin))
+            screens[("price", is_admin)] = price_screen
+            screens[("buy_menu", is_admin)] = buy_menu
+            screens[("help", is_admin)] = help_screen
+            screens[("contact", is_admin)] = contact_screen
+            screens[("agent", is_admin)] = agent_screen
+        # 整体替换，读者不会看到一半新一半旧的缓存
+        self.screens = screens
+    
+    def get_screen(self, name: str, is_admin: bool = False) -> Tuple[str, InlineKeyboardMarkup]:
+        return self.screens[(name, is_admin)]
+    
+    def _build_main_keyboard(self, is_admin: bool) -> InlineKeyboardMarkup:
         keyboard = [
             [
                 InlineKeyboardButton("📅 每日签到", callback_data="checkin"),
@@ -293,16 +2341,567 @@ class EFBotHandlers:
             [
                 InlineKeyboardButton("🛒 购买卡密", callback_data="buy_menu"),
                 InlineKeyboardButton("📞 联系客服", callback_data="contact")
+            ],
+            [
+                InlineKeyboardButton("🏆 排行榜", callback_data="leaderboard")
             ]
         ]
         
         # 管理员额外按钮
-        if user.id in ADMIN_IDS:
+        if is_admin:
             keyboard.append([
                 InlineKeyboardButton("⚙️ 管理面板", callback_data="admin")
             ])
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        return InlineKeyboardMarkup(keyboard)
+    
+    def _build_price_keyboard(self) -> InlineKeyboardMarkup:
+        # 购买选项按钮
+        cards = self.price_list["cards"]
+        buttons = [
+            InlineKeyboardButton(f"🛒 购买{card['name']}", callback_data=f"buy:{card_type}")
+            for card_type, card in cards.items()
+        ]
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        keyboard += [
+            [
+                InlineKeyboardButton("📋 代理政策", callback_data="agent_policy"),
+                InlineKeyboardButton("💬 咨询代理", callback_data="contact_agent")
+            ],
+            [
+                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
+            ]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    def _build_buy_menu_keyboard(self) -> InlineKeyboardMarkup:
+        cards = self.price_list["cards"]
+        buttons = [
+            InlineKeyboardButton(f"{card['name']} - {card['price']:g}元", callback_data=f"buy:{card_type}")
+            for card_type, card in cards.items()
+        ]
+        keyboard = [buttons[i:i + 2] for i in range(0, len(buttons), 2)]
+        keyboard += [
+            [
+                InlineKeyboardButton("代理咨询", callback_data="agent_consult"),
+                InlineKeyboardButton("批量购买", callback_data="bulk_buy")
+            ],
+            [
+                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
+            ]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    def _build_agent_keyboard(self) -> InlineKeyboardMarkup:
+        keyboard = [
+            [
+                InlineKeyboardButton("📞 联系客服", callback_data="contact_agent"),
+                InlineKeyboardButton("💰 价格表", callback_data="price")
+            ],
+            [
+                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
+            ]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+    
+    @staticmethod
+    def _build_back_keyboard(target: str) -> InlineKeyboardMarkup:
+        return InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ 返回", callback_data=target)]])
+    
+    def _build_help_keyboard(self) -> InlineKeyboardMarkup:
+        keyboard = [
+            [
+                InlineKeyboardButton("📞 联系客服", callback_data="contact_cs"),
+                InlineKeyboardButton("📖 使用教程", callback_data="tutorial")
+            ],
+            [
+                InlineKeyboardButton("⚖️ 用户协议", callback_data="tos"),
+                InlineKeyboardButton("🔒 隐私政策", callback_data="privacy")
+            ],
+            [
+                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
+            ]
+        ]
+        return InlineKeyboardMarkup(keyboard)
+
+# ==================== 限流 ====================
+class TokenBucket:
+    """令牌桶：每秒补充 rate 个令牌，最多积攒 capacity 个"""
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+    
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+    
+    def try_acquire(self, n: float = 1) -> bool:
+        self._refill()
+        if self.tokens >= n:
+            self.tokens -= n
+            return True
+        return False
+    
+    def delay(self, n: float = 1) -> float:
+        """距离攒够 n 个令牌还需等待的秒数"""
+        self._refill()
+        return max(0.0, (n - self.tokens) / self.rate)
+    
+    async def acquire(self, n: float = 1):
+        while not self.try_acquire(n):
+            await asyncio.sleep(self.delay(n))
+
+class FloodGuard:
+    """按用户限流并合并重复点击
+    
+    每个 (用户, 消息) 只记住最后执行的操作（按钮数据或命令文本）：
+    FLOOD_DEDUP_WINDOW 秒内再次点击同一个操作不再执行处理器，直接共享
+    那次的结果。所有页面都编辑在同一条消息上，中间执行过别的操作（返回、
+    翻页、切换标签）后再点回来照常执行。其余操作经过每用户令牌桶，超出
+    速率的提示稍后再试。
+    
+    同一用户的更新由 PerUserUpdateProcessor 串行执行，不会有两个同时在跑，
+    所以只需要记住刚执行完的操作。
+    """
+    def __init__(self, rate: float = FLOOD_RATE, burst: float = FLOOD_BURST,
+                 window: float = FLOOD_DEDUP_WINDOW, max_users: int = FLOOD_MAX_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.window = window
+        self.max_users = max_users
+        self._buckets: OrderedDict = OrderedDict()  # 用户ID -> TokenBucket
+        self._recent: OrderedDict = OrderedDict()  # (用户ID, 消息ID) -> (过期时间, 最后的操作, 结果)
+        self.executed = 0
+        self.coalesced = 0
+        self.throttled = 0
+    
+    def _bucket(self, user_id: int) -> TokenBucket:
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = self._buckets[user_id] = TokenBucket(self.rate, self.burst)
+            if len(self._buckets) > self.max_users:
+                self._buckets.popitem(last=False)
+        else:
+            self._buckets.move_to_end(user_id)
+        return bucket
+    
+    def _remember(self, key: Tuple[int, Optional[int]], action: str, result):
+        now = time.monotonic()
+        while self._recent:
+            oldest = next(iter(self._recent.values()))
+            if oldest[0] > now and len(self._recent) < self.max_users:
+                break
+            self._recent.popitem(last=False)
+        self._recent.pop(key, None)
+        self._recent[key] = (now + self.window, action, result)
+    
+    @staticmethod
+    def _action(update: Update) -> Optional[str]:
+        if update.callback_query:
+            return update.callback_query.data
+        if update.message and update.message.text:
+            return update.message.text
+        return None
+    
+    @staticmethod
+    def _message_id(update: Update) -> Optional[int]:
+        # 点击的是哪条消息上的按钮；不同消息上的相同按钮不算重复
+        if update.callback_query and update.callback_query.message:
+            return update.callback_query.message.message_id
+        return None
+    
+    @staticmethod
+    async def _answer(update: Update, text: Optional[str] = None):
+        if update.callback_query:
+            try:
+                await update.callback_query.answer(text, show_alert=text is not None)
+            except Exception:
+                pass  # 回调过期等情况无需处理
+        elif text and update.message:
+            try:
+                await update.message.reply_text(text)
+            except Exception:
+                pass
+    
+    def wrap(self, handler):
+        """包装处理器，返回带限流和合并的处理器"""
+        @functools.wraps(handler)
+        async def guarded(update: Update, context: ContextTypes.DEFAULT_TYPE):
+            user = update.effective_user
+            if user is None:
+                return await handler(update, context)
+            action = self._action(update)
+            key = (user.id, self._message_id(update))
+            
+            # 这条消息上最后执行的就是这个操作且刚执行完：直接共享结果
+            if action is not None:
+                recent = self._recent.get(key)
+                if recent is not None and recent[1] == action and recent[0] > time.monotonic():
+                    self.coalesced += 1
+                    await self._answer(update)
+                    return recent[2]
+            
+            if not self._bucket(user.id).try_acquire():
+                self.throttled += 1
+                await self._answer(update, "⚠️ 操作太频繁，请稍后再试")
+                return None
+            
+            self.executed += 1
+            # 先忘掉这条消息上之前的操作，处理器出错时也不会拿旧结果去合并
+            self._recent.pop(key, None)
+            result = await handler(update, context)
+            if action is not None:
+                self._remember(key, action, result)
+            return result
+        
+        return guarded
+    
+    def stats(self) -> Dict:
+        return {"executed": self.executed, "coalesced": self.coalesced, "throttled": self.throttled}
+
+# ==================== 群发 ====================
+class Broadcaster:
+    """限速群发
+    
+    全局令牌桶控制总速率，每个会话另有令牌桶；遇到 RetryAfter 时全局暂停
+    Telegram 要求的秒数后重试。接收人按主键分页读取，每页结束把游标和
+    统计写入 broadcasts 表，重启后从游标处继续（最多重发一页）。
+    """
+    def __init__(self, db: AsyncDatabase, max_chats: int = BROADCAST_MAX_CHATS):
+        self.db = db
+        self.tasks: Dict[int, asyncio.Task] = {}
+        self._bucket = TokenBucket(BROADCAST_RATE, BROADCAST_RATE)
+        self._chat_buckets: OrderedDict = OrderedDict()  # 会话ID -> TokenBucket，所有群发共用
+        self.max_chats = max_chats
+        self._paused_until = 0.0
+    
+    async def start(self, application: Application, text: str, created_by: int, chat_id: int) -> int:
+        broadcast_id = await self.db.create_broadcast(text, created_by, chat_id)
+        job = {
+            "id": broadcast_id, "text": text, "chat_id": chat_id, "last_user_pk": 0,
+            "sent": 0, "failed": 0, "blocked": 0, "elapsed": 0.0,
+        }
+        self._spawn(application, job)
+        return broadcast_id
+    
+    async def resume(self, application: Application):
+        """重启后继续未完成的群发"""
+        for job in await self.db.get_broadcasts('running'):
+            logger.info("继续群发 #%d（游标 %d）", job["id"], job["last_user_pk"])
+            self._spawn(application, job)
+    
+    async def cancel(self, broadcast_id: int) -> bool:
+        cancelled = await self.db.cancel_broadcast(broadcast_id)
+        task = self.tasks.get(broadcast_id)
+        if task:
+            task.cancel()
+        return cancelled
+    
+    async def stop(self):
+        """停止进行中的群发但保持 running 状态，下次启动时从保存的游标继续"""
+        tasks = list(self.tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    def _spawn(self, application: Application, job: Dict):
+        # 不用 application.create_task：Application.stop() 会等它跑完，群发没发完就无法退出
+        task = asyncio.create_task(self._run(application.bot, job))
+        self.tasks[job["id"]] = task
+        task.add_done_callback(lambda _: self.tasks.pop(job["id"], None))
+    
+    async def _run(self, bot, job: Dict):
+        started = time.monotonic() - job["elapsed"]
+        semaphore = asyncio.Semaphore(BROADCAST_CONCURRENCY)
+        
+        async def deliver(user_id: int):
+            async with semaphore:
+                result = await self._send(bot, user_id, job["text"])
+            job[result] += 1
+        
+        while True:
+            page = await self.db.get_recipients(job["last_user_pk"], BROADCAST_PAGE_SIZE)
+            if not page:
+                break
+            await asyncio.gather(*(deliver(user_id) for _, user_id in page))
+            job["last_user_pk"] = page[-1][0]
+            job["elapsed"] = time.monotonic() - started
+            if not await self._save(job):
+                logger.info("群发 #%d 已取消", job["id"])
+                return
+        
+        job["elapsed"] = time.monotonic() - started
+        await self._save(job, 'done')
+        await self._report(bot, job)
+    
+    async def _save(self, job: Dict, status: str = 'running') -> bool:
+        return await self.db.save_broadcast_progress(
+            job["id"], job["last_user_pk"], job["sent"], job["failed"],
+            job["blocked"], job["elapsed"], status
+        )
+    
+    def _chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = self._chat_buckets[chat_id] = TokenBucket(BROADCAST_PER_CHAT_RATE, 1)
+            if len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        else:
+            self._chat_buckets.move_to_end(chat_id)
+        return bucket
+    
+    async def _send(self, bot, chat_id: int, text: str) -> str:
+        """发送一条消息，返回 sent / blocked / failed"""
+        chat_bucket = self._chat_bucket(chat_id)
+        for attempt in range(BROADCAST_MAX_RETRIES + 1):
+            pause = self._paused_until - time.monotonic()
+            if pause > 0:
+                await asyncio.sleep(pause)
+            await self._bucket.acquire()
+            await chat_bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return "sent"
+            except RetryAfter as e:
+                # 触发限流：全局暂停，所有发送一起等待
+                retry_after = e.retry_after.total_seconds() if isinstance(e.retry_after, timedelta) else e.retry_after
+                self._paused_until = max(self._paused_until, time.monotonic() + retry_after)
+                logger.warning("群发触发限流，暂停 %.1f 秒", retry_after)
+            except Forbidden:
+                return "blocked"  # 用户已屏蔽机器人
+            except BadRequest:
+                return "failed"
+            except NetworkError:
+                await asyncio.sleep(2 ** attempt)
+        return "failed"
+    
+    async def _report(self, bot, job: Dict):
+        elapsed = job["elapsed"] or 1e-9
+        total = job["sent"] + job["failed"] + job["blocked"]
+        text = (
+            f"📢 群发 #{job['id']} 完成\n\n"
+            f"• 成功: {job['sent']}\n"
+            f"• 已屏蔽: {job['blocked']}\n"
+            f"• 失败: {job['failed']}\n"
+            f"• 耗时: {elapsed:.1f}秒\n"
+            f"• 速率: {total / elapsed:.1f} 条/秒"
+        )
+        logger.info(text.replace("\n", " "))
+        if job.get("chat_id"):
+            try:
+                await bot.send_message(chat_id=job["chat_id"], text=text)
+            except Exception:
+                logger.exception("发送群发报告失败")
+
+# ==================== 数据统计 ====================
+def render_stats_chart(days: List[str], daily: Dict[str, Dict[str, float]], card_names: Dict[str, str]) -> bytes:
+    """按日汇总画成 PNG：上图为注册/签到/订单数，下图为各卡种收入
+    
+    服务器上通常没有中文字体，图中使用英文标签。
+    """
+    fig = Figure(figsize=(9, 6), dpi=100)
+    counts, revenue = fig.subplots(2, 1, sharex=True)
+    x = range(len(days))
+    for metric, label in (("signups", "signups"), ("checkins", "check-ins"), ("orders", "orders")):
+        counts.plot(x, [daily.get(metric, {}).get(day, 0) for day in days], label=label)
+    counts.legend(loc="upper left")
+    counts.grid(alpha=0.3)
+    
+    bottom = [0.0] * len(days)
+    for card_type in card_names:
+        values = [daily.get(f"revenue:{card_type}", {}).get(day, 0) for day in days]
+        revenue.bar(x, values, bottom=bottom, label=card_type)
+        bottom = [b + v for b, v in zip(bottom, values)]
+    revenue.legend(loc="upper left")
+    revenue.set_ylabel("revenue")
+    revenue.grid(alpha=0.3, axis="y")
+    
+    step = max(1, len(days) // 10)
+    revenue.set_xticks(list(x)[::step])
+    revenue.set_xticklabels([day[5:] for day in days[::step]], rotation=45)
+    fig.tight_layout()
+    
+    buffer = io.BytesIO()
+    fig.savefig(buffer, format="png")
+    return buffer.getvalue()
+
+# ==================== 会话持久化 ====================
+class SQLitePersistence(BasePersistence):
+    """把 context.user_data 和对话状态存进数据库的持久化
+    
+    - 按用户存储：每个用户一行 pickle，位于该用户所在的分片；
+    - 按需加载：启动时不读取任何用户数据，某用户的第一条更新到来时
+      （refresh_user_data）才读取他的那一行；
+    - 只写有变化的用户：记录每个用户上次写入内容的摘要，内容没变就跳过；
+      需要写的用户交给合并写线程，同一轮写回合并进同一个事务。
+    
+    chat_data、bot_data 和 callback_data 不持久化。
+    """
+    def __init__(self, db: AsyncDatabase, update_interval: float = PERSISTENCE_UPDATE_INTERVAL):
+        super().__init__(
+            store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+            update_interval=update_interval
+        )
+        self.db = db
+        self._digests: Dict[int, Optional[bytes]] = {}  # 用户ID -> 已落库内容的摘要，出现即表示已加载
+        self.loaded = self.saved = self.skipped = 0
+    
+    @staticmethod
+    def _dump(data) -> Optional[bytes]:
+        return pickle.dumps(dict(data), pickle.HIGHEST_PROTOCOL) if data else None
+    
+    @staticmethod
+    def _digest(blob: Optional[bytes]) -> Optional[bytes]:
+        # 摘要相同就跳过写入，必须用抗碰撞的哈希，hash() 碰撞会丢掉改动
+        return hashlib.blake2b(blob).digest() if blob is not None else None
+    
+    # ---------- user_data ----------
+    async def get_user_data(self) -> Dict[int, Dict]:
+        # 不预加载，由 refresh_user_data 逐个用户加载
+        return {}
+    
+    async def refresh_user_data(self, user_id: int, user_data: Dict):
+        if user_id in self._digests:
+            return
+        blob = await self.db.load_user_state(user_id)
+        self._digests[user_id] = self._digest(blob)
+        if blob is not None:
+            # 已在内存中的新值优先
+            for key, value in pickle.loads(blob).items():
+                user_data.setdefault(key, value)
+            self.loaded += 1
+    
+    async def update_user_data(self, user_id: int, data: Dict):
+        if user_id not in self._digests:
+            # 尚未加载过库里的数据，直接覆盖会丢掉它们
+            await self.refresh_user_data(user_id, data)
+        blob = self._dump(data)
+        digest = self._digest(blob)
+        if self._digests.get(user_id) == digest:
+            self.skipped += 1
+            return
+        await self.db.save_user_state(user_id, blob)
+        self._digests[user_id] = digest
+        self.saved += 1
+    
+    async def drop_user_data(self, user_id: int):
+        await self.db.save_user_state(user_id, None)
+        self._digests[user_id] = None
+    
+    # ---------- 对话状态 ----------
+    async def get_conversations(self, name: str) -> Dict:
+        return {
+            tuple(json.loads(key)): pickle.loads(state)
+            for key, state in await self.db.load_conversations(name)
+        }
+    
+    async def update_conversation(self, name: str, key: Tuple, new_state: Optional[object]):
+        state = None if new_state is None else pickle.dumps(new_state, pickle.HIGHEST_PROTOCOL)
+        await self.db.save_conversation(name, json.dumps(list(key)), state)
+    
+    # ---------- 不持久化的数据 ----------
+    async def get_chat_data(self) -> Dict:
+        return {}
+    
+    async def get_bot_data(self) -> Dict:
+        return {}
+    
+    async def get_callback_data(self):
+        return None
+    
+    async def update_chat_data(self, chat_id: int, data: Dict):
+        pass
+    
+    async def update_bot_data(self, data: Dict):
+        pass
+    
+    async def update_callback_data(self, data):
+        pass
+    
+    async def drop_chat_data(self, chat_id: int):
+        pass
+    
+    async def refresh_chat_data(self, chat_id: int, chat_data: Dict):
+        pass
+    
+    async def refresh_bot_data(self, bot_data: Dict):
+        pass
+    
+    async def flush(self):
+        # 每次写回都已等待事务提交，没有积压的数据
+        pass
+    
+    def stats(self) -> Dict:
+        return {"loaded": self.loaded, "saved": self.saved, "skipped": self.skipped}
+
+# ==================== 处理器 ====================
+class EFBotHandlers:
+    def __init__(self, service: Optional[EFBotService] = None):
+        self.service = service or EFBotService()
+        # 与业务层共用同一个 Database，全进程只有一个写连接
+        self.db = AsyncDatabase(self.service.db)
+        self.broadcaster = Broadcaster(self.db)
+        self.flood_guard = FloodGuard()
+        self.metrics_server = None
+        self.background_tasks = set()  # 卡密生成/导入、导出等后台任务
+        self._stats_chart = (None, None)  # ((日期, 汇总版本), 图片 file_id 或 PNG)
+        
+        users = self.service.db.users
+        metrics.gauge("ef_user_cache_size", "缓存中的用户数", lambda: users.stats()["size"])
+        metrics.gauge("ef_user_cache_hit_rate", "用户缓存命中率", lambda: users.stats()["hit_rate"])
+        metrics.gauge("ef_flood_coalesced", "合并的重复点击数", lambda: self.flood_guard.coalesced)
+        metrics.gauge("ef_flood_throttled", "被限流的操作数", lambda: self.flood_guard.throttled)
+    
+    async def post_init(self, application: Application):
+        """启动指标服务，并继续未完成的群发"""
+        if METRICS_PORT:
+            try:
+                self.metrics_server = await serve_metrics(METRICS_LISTEN, METRICS_PORT)
+                logger.info("指标服务: http://%s:%d/metrics", METRICS_LISTEN, METRICS_PORT)
+            except OSError as e:
+                # 同机多进程时端口已被占用：不提供指标服务，机器人照常运行（可用 EF_METRICS_PORT 分开）
+                logger.warning("指标服务启动失败（%s:%d）: %s", METRICS_LISTEN, METRICS_PORT, e)
+        await self.broadcaster.resume(application)
+    
+    def _spawn(self, coroutine) -> asyncio.Task:
+        """启动后台任务；不用 application.create_task，以免 Application.stop() 等它跑完"""
+        task = asyncio.create_task(coroutine)
+        self.background_tasks.add(task)
+        task.add_done_callback(self.background_tasks.discard)
+        return task
+    
+    async def post_stop(self, application: Application):
+        """停止群发和后台任务（群发进度已按页保存，下次启动继续）"""
+        await self.broadcaster.stop()
+        tasks = list(self.background_tasks)
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+    
+    async def shutdown(self, application: Application):
+        """关闭指标服务和数据库线程池"""
+        if self.metrics_server is not None:
+            self.metrics_server.close()
+            await self.metrics_server.wait_closed()
+        self.db.close()
+    
+    async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理 /start 命令"""
+        user = update.effective_user
+        
+        # 保存用户信息
+        await self.db.create_user(
+            user_id=user.id,
+            username=user.username,
+            first_name=user.first_name,
+            last_name=user.last_name or ""
+        )
+        
+        template, reply_markup = self.service.get_screen("main", user.id in ADMIN_IDS)
+        welcome_text = template.format(mention=user.mention_markdown_v2())
         
         await update.message.reply_text(
             welcome_text,
@@ -316,7 +2915,7 @@ class EFBotHandlers:
         await query.answer()
         
         user_id = query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.db.get_user(user_id)
         
         if not user:
             await query.edit_message_text("请先使用 /start 命令注册")
@@ -324,24 +2923,30 @@ class EFBotHandlers:
         
         # 检查今日是否已签到
         today = datetime.now().strftime("%Y-%m-%d")
-        if user[10] == today:  # last_checkin 字段
+        checked_in = None
+        if user.last_checkin != today:
+            # 按真实连续天数计算奖励（签到位图，断签即重新累计）
+            summary = await self.db.get_checkin_summary(user_id, date.today())
+            streak = summary["streak"]
+            coins = 5 + (streak // 7)
+            points = 10 + (streak // 7)
+            
+            # 缓存可能没看到其他进程的签到，以写入时的检查为准
+            checked_in = await self.db.update_checkin(user_id, coins, points)
+        
+        if checked_in is None:
             response = "⚠️ 今天已经签到过了！\n明天再来吧~"
         else:
-            # 计算奖励
-            coins = 5 + (user[8] // 7)  # checkin_days
-            points = 10 + (user[8] // 7)
-            
-            self.db.update_checkin(user_id, coins, points)
-            
+            user = checked_in
             response = f"""✅ *签到成功！*
 
 🎁 今日奖励：
 • 金币: {coins}
 • 积分: {points}
-• 连续签到: {user[8] + 1}天
+• 连续签到: {streak + 1}天
 
-💰 累计金币: {user[6] + coins}
-⭐ 累计积分: {user[7] + points}
+💰 累计金币: {user.coins}
+⭐ 累计积分: {user.points}
 
 💡 提示：连续签到奖励会递增哦！"""
         
@@ -352,36 +2957,15 @@ class EFBotHandlers:
         await query.edit_message_text(
             response,
             reply_markup=reply_markup,
-            parse_mode='MarkdownV2'
-        )
-    
-    async def handle_price(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
-        """处理价格查询"""
-        query = update.callback_query
-        await query.answer()
-        
-        price_message = self.service.format_price_message()
-        
-        # 购买选项按钮
-        keyboard = [
-            [
-                InlineKeyboardButton("🛒 购买天卡", callback_data="buy_day"),
-                InlineKeyboardButton("🛒 购买周卡", callback_data="buy_week")
-            ],
-            [
-                InlineKeyboardButton("🛒 购买月卡", callback_data="buy_month"),
-                InlineKeyboardButton("🛒 购买季卡", callback_data="buy_season")
-            ],
-            [
-                InlineKeyboardButton("📋 代理政策", callback_data="agent_policy"),
-                InlineKeyboardButton("💬 咨询代理", callback_data="contact_agent")
-            ],
-            [
-                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
-            ]
-        ]
+            parse_mode='MarkdownV2'
+        )
+    
+    async def handle_price(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """处理价格查询"""
+        query = update.callback_query
+        await query.answer()
         
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        price_message, reply_markup = self.service.get_screen("price")
         
         await query.edit_message_text(
             price_message,
@@ -389,33 +2973,35 @@ class EFBotHandlers:
             parse_mode='MarkdownV2'
         )
     
+    async def handle_contact(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """联系客服"""
+        query = update.callback_query
+        await query.answer()
+        
+        text, reply_markup = self.service.get_screen("contact")
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
+    async def handle_agent_policy(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """代理政策与提卡价"""
+        query = update.callback_query
+        await query.answer()
+        
+        text, reply_markup = self.service.get_screen("agent")
+        await query.edit_message_text(text, reply_markup=reply_markup)
+    
+    async def handle_unknown_callback(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """未注册的按钮（功能未开放或按钮已过期）"""
+        await update.callback_query.answer("该功能暂未开放或按钮已过期")
+    
     async def handle_buy_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """购买菜单"""
         query = update.callback_query
         await query.answer()
         
-        keyboard = [
-            [
-                InlineKeyboardButton("天卡 - 7元", callback_data="buy_day"),
-                InlineKeyboardButton("周卡 - 30元", callback_data="buy_week")
-            ],
-            [
-                InlineKeyboardButton("月卡 - 60元", callback_data="buy_month"),
-                InlineKeyboardButton("季卡 - 120元", callback_data="buy_season")
-            ],
-            [
-                InlineKeyboardButton("代理咨询", callback_data="agent_consult"),
-                InlineKeyboardButton("批量购买", callback_data="bulk_buy")
-            ],
-            [
-                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        text, reply_markup = self.service.get_screen("buy_menu")
         
         await query.edit_message_text(
-            "🛒 *选择购买项目*\n\n请选择您要购买的商品：",
+            text,
             reply_markup=reply_markup,
             parse_mode='MarkdownV2'
         )
@@ -425,29 +3011,24 @@ class EFBotHandlers:
         query = update.callback_query
         await query.answer()
         
-        card_type = query.data.replace("buy_", "")
+        card_type = parse_callback(query.data).args[0]
         
-        prices = {
-            "day": 7.0,
-            "week": 30.0,
-            "month": 60.0,
-            "season": 120.0
-        }
+        card = self.service.price_list["cards"].get(card_type)
         
-        if card_type not in prices:
+        if card is None:
             await query.edit_message_text("无效的商品类型")
             return
         
-        price = prices[card_type]
+        price = card["price"]
         user_id = query.from_user.id
         
         # 创建订单
-        order_no = self.db.add_order(user_id, card_type, price)
+        order_no = await self.db.add_order(user_id, card_type, price)
         
         payment_message = f"""
 🛒 *订单详情*
 
-📦 商品：{card_type}卡
+📦 商品：{card['name']}
 💰 价格：{price}元
 📋 订单号：{order_no}
 👤 购买人：{query.from_user.username or query.from_user.id}
@@ -473,12 +3054,12 @@ class EFBotHandlers:
         # 支付按钮
         keyboard = [
             [
-                InlineKeyboardButton("💳 支付宝支付", callback_data=f"pay_alipay_{order_no}"),
-                InlineKeyboardButton("💳 微信支付", callback_data=f"pay_wechat_{order_no}")
+                InlineKeyboardButton("💳 支付宝支付", callback_data=f"pay:alipay:{order_no}"),
+                InlineKeyboardButton("💳 微信支付", callback_data=f"pay:wechat:{order_no}")
             ],
             [
-                InlineKeyboardButton("📱 QQ支付", callback_data=f"pay_qq_{order_no}"),
-                InlineKeyboardButton("🔄 其他方式", callback_data=f"pay_other_{order_no}")
+                InlineKeyboardButton("📱 QQ支付", callback_data=f"pay:qq:{order_no}"),
+                InlineKeyboardButton("🔄 其他方式", callback_data=f"pay:other:{order_no}")
             ],
             [
                 InlineKeyboardButton("❌ 取消订单", callback_data="cancel_order"),
@@ -499,23 +3080,7 @@ class EFBotHandlers:
         query = update.callback_query
         await query.answer()
         
-        help_message = self.service.format_help_message()
-        
-        keyboard = [
-            [
-                InlineKeyboardButton("📞 联系客服", callback_data="contact_cs"),
-                InlineKeyboardButton("📖 使用教程", callback_data="tutorial")
-            ],
-            [
-                InlineKeyboardButton("⚖️ 用户协议", callback_data="tos"),
-                InlineKeyboardButton("🔒 隐私政策", callback_data="privacy")
-            ],
-            [
-                InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")
-            ]
-        ]
-        
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        help_message, reply_markup = self.service.get_screen("help")
         
         await query.edit_message_text(
             help_message,
@@ -529,34 +3094,31 @@ class EFBotHandlers:
         await query.answer()
         
         user_id = query.from_user.id
-        user = self.db.get_user(user_id)
+        user = await self.db.get_user(user_id)
         
         if not user:
             profile_text = "请先使用 /start 命令注册"
         else:
-            # 计算本月签到天数
-            cursor = self.db.conn.cursor()
-            month_start = datetime.now().replace(day=1).strftime("%Y-%m-%d")
-            cursor.execute('''
-                SELECT COUNT(*) FROM checkins 
-                WHERE user_id = ? AND checkin_date >= ?
-            ''', (user_id, month_start))
-            month_checkins = cursor.fetchone()[0]
+            # 连续签到与本月签到天数（签到位图）
+            summary = await self.db.get_checkin_summary(user_id, date.today())
+            # 用户名、小数和时间里的 _ . - 在 MarkdownV2 中都要转义
+            md = functools.partial(escape_markdown, version=2)
             
             profile_text = f"""
 👤 *用户信息*
 
 🆔 用户ID: `{user_id}`
-👤 用户名: {user[2] or '未设置'}
-💰 金币余额: {user[6]}
-⭐ 积分余额: {user[7]}
-💵 累计消费: {user[8]}元
-📅 连续签到: {user[9]}天
-✅ 本月签到: {month_checkins}天
-🎖️ VIP等级: {'VIP' + str(user[11]) if user[11] > 0 else '普通用户'}
-📅 注册时间: {user[13]}
-
-*账户状态:* {'正常' if not user[12] else '已过期' if user[12] else '活跃'}
+👤 用户名: {md(user.username or '未设置')}
+💰 金币余额: {md(str(user.coins))}
+⭐ 积分余额: {md(str(user.points))}
+💵 累计消费: {md(str(user.total_spent))}元
+📅 连续签到: {summary['streak']}天
+✅ 本月签到: {summary['month_count']}天
+🗓️ 累计签到: {user.checkin_days}天
+🎖️ VIP等级: {'VIP' + str(user.is_vip) if user.is_vip > 0 else '普通用户'}
+📅 注册时间: {md(str(user.created_at))}
+
+*账户状态:* {'正常' if not user.vip_expiry else '已过期' if user.vip_expiry else '活跃'}
 """
         
         keyboard = [
@@ -581,6 +3143,94 @@ class EFBotHandlers:
             parse_mode='MarkdownV2'
         )
     
+    async def handle_checkin_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """签到记录（分页）"""
+        await self._show_history(
+            update, "checkins", "checkin_history", "📊 签到记录",
+            lambda r: f"{r['checkin_date']}  +{r['coins_earned']}金币 +{r['points_earned']}积分"
+        )
+    
+    async def handle_order_history(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """订单记录（分页）"""
+        status_names = {
+            'pending': '待支付', 'paid': '已付款', 'completed': '已完成', 'cancelled': '已取消', 'expired': '已过期'
+        }
+        await self._show_history(
+            update, "orders", "order_history", "🛒 订单记录",
+            lambda r: (f"{r['created_at']}  {r['card_type']} {r['amount']}元  "
+                       f"{status_names.get(r['status'], r['status'])}\n    订单号 {r['order_no']}")
+        )
+    
+    async def _show_history(self, update: Update, table: str, action: str, title: str, fmt_row):
+        """渲染一页历史记录；callback_data 形如 action、action:n:<id>（更早）、action:p:<id>（更新）"""
+        query = update.callback_query
+        await query.answer()
+        
+        args = parse_callback(query.data).args
+        cursor = int(args[1]) if args and args[1].isdigit() else None
+        older = not args or args[0] == "n"
+        page = await self.db.get_history_page(table, query.from_user.id, cursor, older)
+        rows = page["rows"]
+        
+        if rows:
+            text = f"{title}\n\n" + "\n".join(fmt_row(r) for r in rows)
+        elif cursor is None:
+            text = f"{title}\n\n暂无记录"
+        else:
+            text = f"{title}\n\n没有更多记录了"
+        
+        nav = []
+        if page["has_newer"]:
+            nav.append(InlineKeyboardButton("⬅️ 上一页", callback_data=f"{action}:p:{rows[0]['id']}"))
+        if page["has_older"]:
+            nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"{action}:n:{rows[-1]['id']}"))
+        keyboard = [nav] if nav else []
+        keyboard.append([InlineKeyboardButton("⬅️ 返回", callback_data="profile")])
+        
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def handle_leaderboard(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """排行榜：命令 /leaderboard [指标]，按钮 leaderboard、leaderboard:<指标>"""
+        query = update.callback_query
+        if query:
+            await query.answer()
+            args = parse_callback(query.data).args
+        else:
+            args = context.args or []
+        metric = args[0] if args and args[0] in LEADERBOARD_METRICS else "coins"
+        user_id = update.effective_user.id
+        
+        top, mine = await asyncio.gather(
+            self.db.get_leaderboard(metric), self.db.get_rank(metric, user_id)
+        )
+        users = await asyncio.gather(*(self.db.get_user(uid) for _, uid in top))
+        
+        lines = [f"🏆 排行榜 · {LEADERBOARD_METRICS[metric]}\n"]
+        medals = {1: "🥇", 2: "🥈", 3: "🥉"}
+        rank, previous = 0, None
+        for position, ((score, uid), user) in enumerate(zip(top, users), 1):
+            if score != previous:
+                rank, previous = position, score
+            name = (user.first_name or user.username or str(uid)) if user else str(uid)
+            lines.append(f"{medals.get(rank, f'{rank}.')} {name}  {score:g}")
+        if not top:
+            lines.append("暂无数据")
+        if mine:
+            lines.append(f"\n我的排名：第 {mine['rank']} 名（{mine['score']:g}）")
+        
+        keyboard = [
+            [
+                InlineKeyboardButton(("✅ " if name == metric else "") + label, callback_data=f"leaderboard:{name}")
+                for name, label in LEADERBOARD_METRICS.items()
+            ],
+            [InlineKeyboardButton("⬅️ 返回", callback_data="back_to_main")],
+        ]
+        text = "\n".join(lines)
+        if query:
+            await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+        else:
+            await update.message.reply_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
     async def handle_admin(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """管理面板"""
         query = update.callback_query
@@ -592,25 +3242,19 @@ class EFBotHandlers:
             await query.edit_message_text("⚠️ 权限不足")
             return
         
-        # 获取统计数据
-        cursor = self.db.conn.cursor()
-        
-        # 总用户数
-        cursor.execute('SELECT COUNT(*) FROM users')
-        total_users = cursor.fetchone()[0]
-        
-        # 今日新增
+        # 获取统计数据（内存计数器）
         today = datetime.now().strftime("%Y-%m-%d")
-        cursor.execute('SELECT COUNT(*) FROM users WHERE DATE(created_at) = ?', (today,))
-        today_users = cursor.fetchone()[0]
-        
-        # 总订单数
-        cursor.execute('SELECT COUNT(*) FROM orders')
-        total_orders = cursor.fetchone()[0]
-        
-        # 总销售额
-        cursor.execute('SELECT SUM(amount) FROM orders WHERE status = "completed"')
-        total_sales = cursor.fetchone()[0] or 0
+        stats = await self.db.get_admin_stats(today)
+        total_users = stats["total_users"]
+        today_users = stats["today_users"]
+        total_orders = stats["total_orders"]
+        total_sales = stats["total_sales"]
+        stock_text = " / ".join(
+            f"{card['name']} {stats['stock'].get(card_type, 0)}"
+            for card_type, card in self.service.price_list["cards"].items()
+        )
+        cache_stats = self.db.db.users.stats()
+        flood_stats = self.flood_guard.stats()
         
         admin_text = f"""
 ⚙️ *管理面板*
@@ -620,7 +3264,9 @@ class EFBotHandlers:
 • 今日新增: {today_users}
 • 总订单数: {total_orders}
 • 总销售额: {total_sales:.2f}元
-• 卡密库存: 待统计
+• 卡密库存: {stock_text}
+• 用户缓存命中率: {cache_stats['hit_rate']:.1%}（{cache_stats['size']} 人）
+• 重复点击合并: {flood_stats['coalesced']} / 限流: {flood_stats['throttled']}
 
 👤 当前管理员: {query.from_user.username or query.from_user.id}
 """
@@ -651,52 +3297,673 @@ class EFBotHandlers:
             parse_mode='MarkdownV2'
         )
     
+    async def sweep_orders(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务：过期超时未支付的订单"""
+        started = time.monotonic()
+        result = await self.db.expire_orders()
+        logger.info(
+            "过期订单清理：过期 %d 单，%d 批，用时 %.2fs",
+            result["expired"], result["batches"], time.monotonic() - started
+        )
+    
+    async def resync_mirrors(self, context: ContextTypes.DEFAULT_TYPE):
+        """定时任务：从数据库同步内存计数器和排行榜，纳入其他进程的写入"""
+        await self.db.resync_mirrors()
+    
+    async def handle_metrics(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /metrics：各处理器、数据库调用和 API 调用的次数与延迟摘要"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        
+        sections = [("🧩 处理器", "handler"), ("🗄️ 数据库", "db"), ("📡 Telegram API", "telegram_api")]
+        lines = [f"📈 运行指标（耗时抽样 {metrics.sample_rate:.0%}）"]
+        for title, family in sections:
+            rows = metrics.snapshot(family)
+            lines.append(f"\n{title}")
+            if not rows:
+                lines.append("  暂无数据")
+            for row in rows[:10]:
+                lines.append(
+                    f"  {row['label']}: {row['calls']} 次"
+                    + (f"，失败 {row['errors']}" if row['errors'] else "")
+                    + f"，p50 {row['p50'] * 1000:.1f}ms / p99 {row['p99'] * 1000:.1f}ms"
+                )
+        if METRICS_PORT:
+            lines.append(f"\n完整指标: http://{METRICS_LISTEN}:{METRICS_PORT}/metrics")
+        
+        await update.message.reply_text("\n".join(lines))
+    
+    @staticmethod
+    def _user_button(row: Dict) -> InlineKeyboardButton:
+        name = " ".join(filter(None, (row["first_name"], row["last_name"]))) or "-"
+        label = f"{name} (@{row['username']})" if row["username"] else name
+        return InlineKeyboardButton(f"{label} · {row['user_id']}", callback_data=f"admin_user:{row['user_id']}")
+    
+    async def handle_admin_users(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """用户管理：keyset 分页的用户列表，callback_data 形如 admin_users、admin_users:<游标>"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        args = parse_callback(query.data).args
+        before = int(args[0]) if args and args[0].isdigit() else None
+        page = await self.db.get_user_page(before)
+        rows = page["rows"]
+        
+        total = (await self.db.get_admin_stats(datetime.now().strftime("%Y-%m-%d")))["total_users"]
+        text = f"👥 用户管理（共 {total} 人）\n\n点击用户查看详情，搜索请发送 /users <用户名/姓名/ID>"
+        if not rows:
+            text += "\n\n没有更多用户了"
+        
+        keyboard = [[self._user_button(row)] for row in rows]
+        nav = []
+        if before is not None:
+            nav.append(InlineKeyboardButton("⏮ 第一页", callback_data="admin_users"))
+        if page["has_more"]:
+            nav.append(InlineKeyboardButton("下一页 ➡️", callback_data=f"admin_users:{rows[-1]['id']}"))
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("⬅️ 返回", callback_data="admin")])
+        
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    async def handle_user_search(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /users <关键词>：按用户名、姓名或用户ID搜索"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        keyword = " ".join(context.args or []).strip().lstrip("@")
+        if not keyword.isdigit() and len(keyword) < USER_SEARCH_MIN_LENGTH:
+            await update.message.reply_text(
+                f"用法: /users <关键词>（至少 {USER_SEARCH_MIN_LENGTH} 个字符，或完整的用户ID）"
+            )
+            return
+        
+        rows = await self.db.search_users(keyword)
+        if not rows:
+            await update.message.reply_text(f"🔍 没有找到与「{keyword}」匹配的用户")
+            return
+        keyboard = [[self._user_button(row)] for row in rows]
+        await update.message.reply_text(
+            f"🔍 「{keyword}」的搜索结果（最新的 {len(rows)} 个）",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def handle_admin_user_detail(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """用户详情：资料、签到与最近订单"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        arg = parse_callback(query.data).args[0]
+        user = await self.db.get_user(int(arg)) if arg.isdigit() else None
+        keyboard = InlineKeyboardMarkup([[InlineKeyboardButton("⬅️ 返回", callback_data="admin_users")]])
+        if user is None:
+            await query.edit_message_text("❌ 用户不存在", reply_markup=keyboard)
+            return
+        
+        summary = await self.db.get_checkin_summary(user.user_id, date.today())
+        orders = (await self.db.get_history_page("orders", user.user_id))["rows"][:5]
+        name = " ".join(filter(None, (user.first_name, user.last_name))) or "-"
+        lines = [
+            f"👤 {name}" + (f" (@{user.username})" if user.username else ""),
+            f"ID: {user.user_id}",
+            f"注册时间: {user.created_at}",
+            f"金币 {user.coins} / 积分 {user.points} / 累计消费 {user.total_spent:.2f}元",
+            f"签到 {user.checkin_days} 天，连续 {summary['streak']} 天，最近 {user.last_checkin or '-'}",
+            f"VIP: {'是，到期 ' + str(user.vip_expiry) if user.is_vip else '否'}",
+        ]
+        if orders:
+            lines.append("\n最近订单：")
+            lines += [f"• {o['created_at']} {o['card_type']} {o['amount']}元 {o['status']}  {o['order_no']}" for o in orders]
+        await query.edit_message_text("\n".join(lines), reply_markup=keyboard)
+    
+    async def handle_admin_stats(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """数据统计：近 7/30/90 天汇总与趋势图，数据来自按日汇总表"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        version = self.service.db.stats_version
+        today = date.today()
+        days = [(today - timedelta(days=i)).isoformat() for i in range(max(STATS_PERIODS) - 1, -1, -1)]
+        daily = await self.db.get_daily_stats(days[0])
+        cards = {card_type: card["name"] for card_type, card in self.service.price_list["cards"].items()}
+        
+        def total(metric: str, period: int) -> float:
+            series = daily.get(metric, {})
+            return sum(series.get(day, 0) for day in days[-period:])
+        
+        lines = [
+            "📈 数据统计",
+            f"\n今日：新增用户 {total('signups', 1):.0f}，签到 {total('checkins', 1):.0f}，"
+            f"订单 {total('orders', 1):.0f}，收入 {total('revenue', 1):.2f}元",
+        ]
+        for period in STATS_PERIODS:
+            lines.append(
+                f"\n近 {period} 天：新增用户 {total('signups', period):.0f}，签到 {total('checkins', period):.0f}，"
+                f"订单 {total('orders', period):.0f}，收入 {total('revenue', period):.2f}元"
+            )
+        period = STATS_PERIODS[1]
+        lines.append(f"\n近 {period} 天各卡种：")
+        for card_type, name in cards.items():
+            lines.append(
+                f"• {name}: 订单 {total(f'orders:{card_type}', period):.0f}，"
+                f"收入 {total(f'revenue:{card_type}', period):.2f}元"
+            )
+        
+        keyboard = [[InlineKeyboardButton("⬅️ 返回", callback_data="admin")]]
+        await query.edit_message_text("\n".join(lines), reply_markup=InlineKeyboardMarkup(keyboard))
+        
+        if Figure is None:
+            return
+        # 图只画到昨天，当天的实时数据见上面的文字；日期和已结束日期的汇总都没变时复用上次上传的图片
+        key = (days[-1], version)
+        cached_key, photo = self._stats_chart
+        if cached_key != key or photo is None:
+            chart_days = days[-period - 1:-1]
+            loop = asyncio.get_running_loop()
+            photo = await loop.run_in_executor(None, render_stats_chart, chart_days, daily, cards)
+        message = await context.bot.send_photo(
+            query.message.chat_id, photo, caption=f"截至昨天的近 {period} 天趋势"
+        )
+        self._stats_chart = (key, message.photo[-1].file_id if message.photo else photo)
+    
+    async def handle_recount(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /recount：从原始数据重建统计计数器并报告差异"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        
+        await update.message.reply_text("🔄 正在重新统计，请稍候...")
+        diffs = await self.db.recount_counters()
+        
+        if not diffs:
+            await update.message.reply_text("✅ 统计计数器校对完成，全部一致")
+            return
+        
+        lines = [f"• {name}: {old:g} → {new:g}" for name, (old, new) in diffs.items()]
+        await update.message.reply_text(
+            f"⚠️ 发现 {len(diffs)} 项不一致，已按重算结果修正：\n" + "\n".join(lines[:50])
+        )
+    
+    async def handle_confirm(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /confirm <订单号>：确认收款并自动发放卡密"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        if not context.args:
+            await update.message.reply_text("用法: /confirm <订单号>")
+            return
+        
+        order_no = context.args[0]
+        result = await self.db.dispense_card(order_no)
+        status = result["status"]
+        
+        if status == "not_found":
+            await update.message.reply_text(f"❌ 订单 {order_no} 不存在")
+            return
+        if status == "not_pending":
+            await update.message.reply_text(f"⚠️ 订单 {order_no} 已取消或状态异常，无法确认")
+            return
+        if status == "out_of_stock":
+            await update.message.reply_text(
+                f"⚠️ {result['card_type']} 卡密库存不足，订单已记为已付款，补货后重新 /confirm {order_no}"
+            )
+            return
+        if status == "done":
+            await update.message.reply_text(f"ℹ️ 订单 {order_no} 已发放过卡密: {result['card_key']}")
+            return
+        
+        card = self.service.price_list["cards"].get(result["card_type"], {})
+        await context.bot.send_message(
+            chat_id=result["user_id"],
+            text=(
+                f"✅ 订单 {order_no} 已确认\n\n"
+                f"📦 商品：{card.get('name', result['card_type'])}\n"
+                f"🔑 卡密：{result['card_key']}\n\n"
+                "请妥善保管，如有问题请联系客服"
+            )
+        )
+        await update.message.reply_text(f"✅ 订单 {order_no} 已发放卡密给用户 {result['user_id']}")
+    
+    async def handle_gen_cards_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """生成卡密入口：说明生成和导入的用法"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        types = ", ".join(
+            f"{card_type}({card['name']})"
+            for card_type, card in self.service.price_list["cards"].items()
+        )
+        text = (
+            "🔄 生成卡密\n\n"
+            f"批量生成：/gencards <类型> <数量> [单价]\n"
+            f"例如：/gencards day 10000\n\n"
+            "导入卡密：发送 txt 文件（每行一个卡密），\n"
+            "文件说明填写 /importcards <类型> [单价]\n\n"
+            f"可用类型：{types}"
+        )
+        keyboard = [[InlineKeyboardButton("⬅️ 返回", callback_data="admin")]]
+        await query.edit_message_text(text, reply_markup=InlineKeyboardMarkup(keyboard))
+    
+    def _parse_card_args(self, args: List[str]) -> Tuple[Optional[str], Optional[float]]:
+        """解析 <类型> [单价]，类型无效时返回 (None, None)"""
+        cards = self.service.price_list["cards"]
+        if not args or args[0] not in cards:
+            return None, None
+        try:
+            price = float(args[1]) if len(args) > 1 else cards[args[0]]["price"]
+        except ValueError:
+            return None, None
+        return args[0], price
+    
+    async def handle_gen_cards(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /gencards <类型> <数量> [单价]：后台批量生成卡密"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        
+        args = context.args or []
+        card_type, price = self._parse_card_args(args[:1] + args[2:])
+        try:
+            count = int(args[1])
+        except (IndexError, ValueError):
+            count = 0
+        if card_type is None or not 0 < count <= CARD_GEN_MAX:
+            await update.message.reply_text(f"用法: /gencards <类型> <数量(1-{CARD_GEN_MAX})> [单价]")
+            return
+        
+        await update.message.reply_text(f"⏳ 开始生成 {count} 张 {card_type} 卡密...")
+        self._spawn(self._run_card_job(update, self.db.generate_cards(card_type, count, price), "生成"))
+    
+    async def handle_import_cards(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员发送卡密文件（说明: /importcards <类型> [单价]）：后台流式导入"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        
+        card_type, price = self._parse_card_args(update.message.caption.split()[1:])
+        if card_type is None:
+            await update.message.reply_text("用法: 发送卡密文件，说明填写 /importcards <类型> [单价]")
+            return
+        
+        fd, path = tempfile.mkstemp(prefix="ef_cards_", suffix=".txt")
+        os.close(fd)
+        file = await update.message.document.get_file()
+        await file.download_to_drive(path)
+        
+        async def job():
+            try:
+                return await self.db.import_card_file(path, card_type, price)
+            finally:
+                os.remove(path)
+        
+        await update.message.reply_text(f"⏳ 开始导入 {card_type} 卡密...")
+        self._spawn(self._run_card_job(update, job(), "导入"))
+    
+    async def _run_card_job(self, update: Update, job, action: str):
+        """等待后台卡密任务完成并汇报结果"""
+        started = time.monotonic()
+        try:
+            result = await job
+        except Exception:
+            logger.exception("卡密%s失败", action)
+            await update.message.reply_text(f"❌ 卡密{action}失败，请查看日志")
+            return
+        await update.message.reply_text(
+            f"✅ 卡密{action}完成\n"
+            f"• 入库: {result['inserted']}\n"
+            f"• 重复: {result['duplicates']}\n"
+            f"• 耗时: {time.monotonic() - started:.1f}秒"
+        )
+    
+    async def handle_export_menu(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """导出数据入口：选择导出格式"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        keyboard = [
+            [
+                InlineKeyboardButton("📄 CSV", callback_data="export:csv"),
+                InlineKeyboardButton("📄 JSONL", callback_data="export:jsonl")
+            ],
+            [
+                InlineKeyboardButton("⬅️ 返回", callback_data="admin")
+            ]
+        ]
+        await query.edit_message_text(
+            f"📤 导出数据\n\n将导出 {', '.join(EXPORT_TABLES)} 表（gzip 压缩），请选择格式：",
+            reply_markup=InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def handle_export(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """后台流式导出各表，并以文件形式发送给管理员"""
+        query = update.callback_query
+        await query.answer()
+        
+        if query.from_user.id not in ADMIN_IDS:
+            await query.edit_message_text("⚠️ 权限不足")
+            return
+        
+        fmt = parse_callback(query.data).args[0]
+        if fmt not in ("csv", "jsonl"):
+            await query.edit_message_text("无效的导出格式")
+            return
+        await query.edit_message_text(f"⏳ 正在导出（{fmt}），完成后会发送文件...")
+        self._spawn(self._run_export(context, query.message.chat_id, fmt))
+    
+    async def _run_export(self, context: ContextTypes.DEFAULT_TYPE, chat_id: int, fmt: str):
+        stamp = datetime.now().strftime("%Y%m%d_%H%M%S")
+        for table in EXPORT_TABLES:
+            fd, path = tempfile.mkstemp(prefix=f"ef_{table}_", suffix=f".{fmt}.gz")
+            os.close(fd)
+            try:
+                count = await self.db.export_table(table, path, fmt)
+                with open(path, 'rb') as f:
+                    await context.bot.send_document(
+                        chat_id=chat_id,
+                        document=f,
+                        filename=f"{table}_{stamp}.{fmt}.gz",
+                        caption=f"📤 {table}: {count} 行"
+                    )
+            except Exception:
+                logger.exception("导出 %s 失败", table)
+                await context.bot.send_message(chat_id=chat_id, text=f"❌ 导出 {table} 失败，请查看日志")
+            finally:
+                os.remove(path)
+    
+    async def handle_broadcast(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /broadcast <内容>：向所有注册用户群发消息"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        
+        # 保留原始换行，去掉命令本身
+        parts = update.message.text.split(maxsplit=1)
+        if len(parts) < 2:
+            await update.message.reply_text("用法: /broadcast <内容>")
+            return
+        
+        broadcast_id = await self.broadcaster.start(
+            context.application, parts[1], update.effective_user.id, update.effective_chat.id
+        )
+        await update.message.reply_text(
+            f"📢 群发 #{broadcast_id} 已开始，完成后会发送统计\n"
+            f"取消: /broadcast_cancel {broadcast_id}"
+        )
+    
+    async def handle_broadcast_cancel(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        """管理员命令 /broadcast_cancel <任务ID>"""
+        if update.effective_user.id not in ADMIN_IDS:
+            await update.message.reply_text("⚠️ 权限不足")
+            return
+        try:
+            broadcast_id = int(context.args[0])
+        except (IndexError, ValueError):
+            await update.message.reply_text("用法: /broadcast_cancel <任务ID>")
+            return
+        
+        if await self.broadcaster.cancel(broadcast_id):
+            await update.message.reply_text(f"🛑 群发 #{broadcast_id} 已取消")
+        else:
+            await update.message.reply_text(f"⚠️ 群发 #{broadcast_id} 不存在或已结束")
+    
     async def back_to_main(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """返回主菜单"""
         query = update.callback_query
         await query.answer()
         
-        # 重新发送开始菜单
+        # 在原消息上显示开始菜单
         await self.start_with_query(query)
+    
+    async def start_with_query(self, query):
+        """把按钮所在的消息改为开始菜单"""
+        user = query.from_user
+        template, reply_markup = self.service.get_screen("main", user.id in ADMIN_IDS)
+        await query.edit_message_text(
+            template.format(mention=user.mention_markdown_v2()),
+            reply_markup=reply_markup,
+            parse_mode='MarkdownV2'
+        )
+
+# ==================== 回调路由 ====================
+class CallbackData(NamedTuple):
+    action: str
+    args: Tuple[str, ...]
+
+
+# 改用冒号格式之前发出的旧按钮仍留在用户的聊天记录里，解析时换成新格式
+LEGACY_CALLBACKS = (
+    (re.compile(r"^buy_(?!menu$)(\w+)$"), r"buy:\1"),
+    (re.compile(r"^pay_(alipay|wechat|qq|other)_(\w+)$"), r"pay:\1:\2"),
+    (re.compile(r"^export_(csv|jsonl)$"), r"export:\1"),
+    # 旧版所有 agent_ 开头的按钮都由同一个处理器接收
+    (re.compile(r"^agent_(?!policy$|consult$)\w+$"), "agent_policy"),
+)
+
+
+def parse_callback(data: Optional[str]) -> CallbackData:
+    """解析 callback_data："action" 或 "action:arg1:arg2"，旧格式先按 LEGACY_CALLBACKS 转换"""
+    data = data or ""
+    if ":" not in data:
+        for pattern, replacement in LEGACY_CALLBACKS:
+            data, converted = pattern.subn(replacement, data)
+            if converted:
+                break
+    action, *args = data.split(":")
+    return CallbackData(action, tuple(args))
+
+
+class CallbackRouter:
+    """按钮回调的字典路由
+    
+    所有按钮共用一个 CallbackQueryHandler：解析出 action 后查字典分发，
+    按钮再多，每次点击的路由开销也不变。登记时声明允许的参数个数，
+    不符合的和未登记的 action 一律交给 fallback。
+    """
+    def __init__(self, fallback):
+        self.fallback = fallback
+        self._routes: Dict[str, Tuple[object, Tuple[int, ...]]] = {}  # action -> (处理器, 允许的参数个数)
+    
+    def register(self, action: str, handler, nargs: Tuple[int, ...] = (0,)):
+        if action in self._routes:
+            raise ValueError(f"重复登记的回调: {action}")
+        self._routes[action] = (handler, nargs)
+    
+    def resolve(self, data: Optional[str]):
+        callback = parse_callback(data)
+        route = self._routes.get(callback.action)
+        if route is None or len(callback.args) not in route[1]:
+            return self.fallback
+        return route[0]
+    
+    async def dispatch(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
+        return await self.resolve(update.callback_query.data)(update, context)
+
+# ==================== 更新调度 ====================
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """并发处理更新，同一用户的更新按到达顺序串行执行
+    
+    process_update 由 PTB 标记为 final，全局并发名额由它控制。
+    do_process_update 中：该用户没有更新在执行时直接执行，并在执行完后
+    接着处理该用户排队的更新；已有更新在执行时只把本条放进该用户的队列
+    就返回，让出全局名额。这样每个用户最多占一个名额，某个用户连续点击
+    不会拖慢其他用户。
+    """
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(max_concurrent_updates)
+        self._queues: Dict[int, deque] = {}  # 用户ID -> 等待执行的协程，存在即表示该用户有更新在执行
+    
+    @staticmethod
+    def _update_key(update: object) -> Optional[int]:
+        if not isinstance(update, Update):
+            return None
+        if update.effective_user:
+            return update.effective_user.id
+        if update.effective_chat:
+            return update.effective_chat.id
+        return None
+    
+    async def do_process_update(self, update: object, coroutine):
+        key = self._update_key(update)
+        if key is None:
+            await coroutine
+            return
+        
+        queue = self._queues.get(key)
+        if queue is not None:
+            queue.append(coroutine)
+            return
+        
+        queue = self._queues[key] = deque([coroutine])
+        try:
+            while queue:
+                try:
+                    await queue[0]
+                except Exception:
+                    # Application.process_update 自己会调用错误处理器，这里只保证队列继续
+                    logger.exception("处理用户 %s 的更新出错", key)
+                finally:
+                    queue.popleft()
+        finally:
+            del self._queues[key]
+            for pending in queue:
+                pending.close()  # 被取消时未执行的更新
+    
+    async def initialize(self):
+        pass
+    
+    async def shutdown(self):
+        pass
 
 # ==================== 主程序 ====================
 def main():
     """启动Bot"""
-    # 创建应用
-    application = Application.builder().token(TOKEN).build()
-    
     # 初始化处理器
     handlers = EFBotHandlers()
     
+    # 创建应用
+    builder = (
+        Application.builder()
+        .token(TOKEN)
+        .concurrent_updates(PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES))
+        .post_init(handlers.post_init)
+        .post_stop(handlers.post_stop)
+        .post_shutdown(handlers.shutdown)
+        # 记录每次 Bot API 调用；连接池大小与 ApplicationBuilder 的默认值一致
+        .request(InstrumentedRequest(connection_pool_size=256))
+        # user_data 与对话状态按用户存入数据库
+        .persistence(SQLitePersistence(handlers.db))
+    )
+    if TELEGRAM_API_BASE:
+        builder = (
+            builder
+            .base_url(f"{TELEGRAM_API_BASE}/bot")
+            .base_file_url(f"{TELEGRAM_API_BASE}/file/bot")
+        )
+    application = builder.build()
+    
+    # 定时清理过期订单（JobQueue 需要 python-telegram-bot[job-queue]）
+    if application.job_queue is not None:
+        application.job_queue.run_repeating(
+            handlers.sweep_orders, interval=ORDER_SWEEP_INTERVAL, first=ORDER_SWEEP_INTERVAL,
+            name="sweep_orders"
+        )
+        if MIRROR_RESYNC_INTERVAL:
+            application.job_queue.run_repeating(
+                handlers.resync_mirrors, interval=MIRROR_RESYNC_INTERVAL, first=MIRROR_RESYNC_INTERVAL,
+                name="resync_mirrors"
+            )
+    else:
+        logger.warning(
+            "未安装 JobQueue，过期订单清理和多进程计数同步未启用：pip install \"python-telegram-bot[job-queue]\""
+        )
+    
+    # 所有处理器都经过按用户限流与重复点击合并，实际执行时记录指标
+    def guard(handler, name: Optional[str] = None):
+        return handlers.flood_guard.wrap(metrics.track_handler(handler, name))
+    
     # 注册命令处理器
-    application.add_handler(CommandHandler("start", handlers.start))
-    application.add_handler(CommandHandler("checkin", handlers.handle_checkin))
-    application.add_handler(CommandHandler("price", lambda u, c: handlers.handle_price(u, c)))
-    application.add_handler(CommandHandler("help", lambda u, c: handlers.handle_help(u, c)))
-    application.add_handler(CommandHandler("profile", lambda u, c: handlers.handle_profile(u, c)))
-    application.add_handler(CommandHandler("admin", handlers.handle_admin))
-    
-    # 注册回调查询处理器
-    application.add_handler(CallbackQueryHandler(handlers.handle_checkin, pattern="^checkin$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_price, pattern="^price$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_buy_menu, pattern="^buy_menu$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_buy, pattern="^buy_"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_help, pattern="^help$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_profile, pattern="^profile$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_admin, pattern="^admin$"))
-    application.add_handler(CallbackQueryHandler(handlers.back_to_main, pattern="^back_to_main$"))
-    
-    # 其他回调
-    application.add_handler(CallbackQueryHandler(handlers.handle_checkin, pattern="^contact$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_checkin, pattern="^contact_cs$"))
-    application.add_handler(CallbackQueryHandler(handlers.handle_checkin, pattern="^agent_"))
+    application.add_handler(CommandHandler("start", guard(handlers.start)))
+    application.add_handler(CommandHandler("checkin", guard(handlers.handle_checkin)))
+    application.add_handler(CommandHandler("price", guard(lambda u, c: handlers.handle_price(u, c), "handle_price")))
+    application.add_handler(CommandHandler("help", guard(lambda u, c: handlers.handle_help(u, c), "handle_help")))
+    application.add_handler(CommandHandler("profile", guard(lambda u, c: handlers.handle_profile(u, c), "handle_profile")))
+    application.add_handler(CommandHandler("admin", guard(handlers.handle_admin)))
+    application.add_handler(CommandHandler("recount", guard(handlers.handle_recount)))
+    application.add_handler(CommandHandler("metrics", guard(handlers.handle_metrics)))
+    application.add_handler(CommandHandler("users", guard(handlers.handle_user_search)))
+    application.add_handler(CommandHandler("leaderboard", guard(handlers.handle_leaderboard)))
+    application.add_handler(CommandHandler("confirm", guard(handlers.handle_confirm)))
+    application.add_handler(CommandHandler("gencards", guard(handlers.handle_gen_cards)))
+    application.add_handler(CommandHandler("broadcast", guard(handlers.handle_broadcast)))
+    application.add_handler(CommandHandler("broadcast_cancel", guard(handlers.handle_broadcast_cancel)))
+    application.add_handler(MessageHandler(
+        filters.Document.ALL & filters.CaptionRegex(r'^/importcards'),
+        guard(handlers.handle_import_cards)
+    ))
+    
+    # 注册回调查询处理器：所有按钮经同一个路由按 action 分发
+    router = CallbackRouter(handlers.handle_unknown_callback)
+    router.register("checkin", guard(handlers.handle_checkin))
+    router.register("price", guard(handlers.handle_price))
+    router.register("buy_menu", guard(handlers.handle_buy_menu))
+    router.register("buy", guard(handlers.handle_buy), nargs=(1,))
+    router.register("help", guard(handlers.handle_help))
+    router.register("profile", guard(handlers.handle_profile))
+    router.register("checkin_history", guard(handlers.handle_checkin_history), nargs=(0, 2))
+    router.register("order_history", guard(handlers.handle_order_history), nargs=(0, 2))
+    router.register("contact", guard(handlers.handle_contact))
+    router.register("contact_cs", guard(handlers.handle_contact))
+    router.register("contact_agent", guard(handlers.handle_contact))
+    router.register("agent_policy", guard(handlers.handle_agent_policy))
+    router.register("agent_consult", guard(handlers.handle_agent_policy))
+    router.register("leaderboard", guard(handlers.handle_leaderboard), nargs=(0, 1))
+    router.register("admin", guard(handlers.handle_admin))
+    router.register("admin_stats", guard(handlers.handle_admin_stats))
+    router.register("admin_users", guard(handlers.handle_admin_users), nargs=(0, 1))
+    router.register("admin_user", guard(handlers.handle_admin_user_detail), nargs=(1,))
+    router.register("gen_cards", guard(handlers.handle_gen_cards_menu))
+    router.register("export_data", guard(handlers.handle_export_menu))
+    router.register("export", guard(handlers.handle_export), nargs=(1,))
+    router.register("back_to_main", guard(handlers.back_to_main))
+    application.add_handler(CallbackQueryHandler(router.dispatch))
     
     print("🤖 EF Telegram Bot 启动中...")
     print(f"🔗 机器人链接: https://t.me/{(TOKEN.split(':')[0])}_bot")
     print("📱 使用 /start 命令开始")
     
     # 启动Bot
-    application.run_polling(allowed_updates=Update.ALL_TYPES)
+    if RUN_MODE == "webhook":
+        application.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL or f'http://{WEBHOOK_LISTEN}:{WEBHOOK_PORT}'}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        application.run_polling(allowed_updates=Update.ALL_TYPES)
 
 if __name__ == '__main__':
     main()
\ No newline at end of file
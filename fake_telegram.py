@@ -0,0 +1,353 @@
+"""本地 Telegram Bot API 替身，用于在不联网的情况下压测 webhook 与长轮询两种模式
+
+用法：
+    # 1. 启动替身（等待机器人注册 webhook 或开始 getUpdates 后自动开始压测）
+    python fake_telegram.py --port 8081 --updates 5000 --users 200
+
+    # 2a. 让机器人使用替身 API 并以 webhook 模式运行
+    EF_TELEGRAM_API=http://127.0.0.1:8081 EF_RUN_MODE=webhook python ef_telegram_bot.py
+
+    # 2b. 或以长轮询模式运行，比较两种模式的数据
+    EF_TELEGRAM_API=http://127.0.0.1:8081 EF_RUN_MODE=polling python ef_telegram_bot.py
+
+替身实现了机器人用到的 Bot API 方法（getMe、setWebhook、getUpdates、
+sendMessage、editMessageText、answerCallbackQuery 等）。webhook 模式下向
+注册的地址推送模拟的按钮点击，长轮询模式下把它们放进 getUpdates 的队列；
+以机器人回调 answerCallbackQuery 的时间计算端到端延迟，最后输出吞吐量、
+延迟分位数和替身自身的处理耗时。
+
+API 服务和压测驱动各跑在自己的线程和事件循环里，互不抢占；同时未应答的
+更新数不超过 --concurrency，延迟反映的是机器人而不是推送积压。
+"""
+import argparse
+import asyncio
+import itertools
+import json
+import random
+import socket
+import threading
+import time
+from collections import deque
+from typing import Dict, List, Optional
+from urllib.parse import parse_qsl, urlsplit
+
+# 压测时模拟点击的按钮
+LOAD_CALLBACKS = ["price", "help", "buy_menu", "profile", "checkin"]
+
+BOT_USER = {
+    "id": 1000000001,
+    "is_bot": True,
+    "first_name": "EF Test Bot",
+    "username": "ef_test_bot",
+    "can_join_groups": False,
+    "can_read_all_group_messages": False,
+    "supports_inline_queries": False,
+}
+
+# 结果固定的方法直接返回编码好的响应
+OK_TRUE = b'{"ok":true,"result":true}'
+OK_EMPTY = b'{"ok":true,"result":[]}'
+OK_ME = json.dumps({"ok": True, "result": BOT_USER}).encode()
+
+
+def ok(result) -> bytes:
+    return json.dumps({"ok": True, "result": result}, separators=(",", ":")).encode()
+
+
+# ==================== Bot API 替身 ====================
+class FakeTelegram:
+    def __init__(self):
+        self.webhook_url: Optional[str] = None
+        self.webhook_secret: Optional[str] = None
+        self.mode: Optional[str] = None  # 机器人注册 webhook 或开始 getUpdates 后确定
+        self.ready = threading.Event()
+        self.calls: Dict[str, int] = {}
+        self.busy = 0.0  # 处理 API 调用累计耗时（秒）
+        self.on_answer = None  # 压测驱动注册的回调：callback_query_id -> None
+        self._message_ids = itertools.count(1)
+        self._updates: deque = deque()
+        self._has_updates: Optional[asyncio.Event] = None
+        self.loop: Optional[asyncio.AbstractEventLoop] = None
+
+    def _set_mode(self, mode: str):
+        if self.mode is None:
+            self.mode = mode
+            self.ready.set()
+
+    def _message(self, params: Dict) -> Dict:
+        return {
+            "message_id": next(self._message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params.get("chat_id", 0)), "type": "private"},
+            "text": params.get("text", ""),
+        }
+
+    # ---------- 长轮询队列 ----------
+    def enqueue(self, updates: List[Dict]):
+        """由压测驱动线程调用，把更新交给 API 线程的 getUpdates"""
+        self.loop.call_soon_threadsafe(self._enqueue, updates)
+
+    def _enqueue(self, updates: List[Dict]):
+        self._updates.extend(updates)
+        self._has_updates.set()
+
+    async def _get_updates(self, params: Dict) -> bytes:
+        offset = int(params.get("offset") or 0)
+        while self._updates and self._updates[0]["update_id"] < offset:
+            self._updates.popleft()
+        if not self._updates:
+            self._has_updates.clear()
+            try:
+                await asyncio.wait_for(self._has_updates.wait(), float(params.get("timeout") or 0))
+            except asyncio.TimeoutError:
+                return OK_EMPTY
+        limit = int(params.get("limit") or 100)
+        return ok(list(itertools.islice(self._updates, limit)))
+
+    async def call(self, method: str, params: Dict) -> bytes:
+        """处理一次 Bot API 调用，返回编码好的响应"""
+        self.calls[method] = self.calls.get(method, 0) + 1
+
+        if method == "answerCallbackQuery":
+            if self.on_answer:
+                self.on_answer(str(params.get("callback_query_id")))
+            return OK_TRUE
+        if method in ("sendMessage", "sendDocument", "sendPhoto"):
+            return ok(self._message(params))
+        if method == "editMessageText":
+            return ok(self._message(params)) if "chat_id" in params else OK_TRUE
+        if method == "getUpdates":
+            self._set_mode("polling")
+            return await self._get_updates(params)
+        if method == "getMe":
+            return OK_ME
+        if method == "setWebhook":
+            self.webhook_url = params.get("url")
+            self.webhook_secret = params.get("secret_token")
+            self._set_mode("webhook")
+            return OK_TRUE
+        if method == "getWebhookInfo":
+            return ok({
+                "url": self.webhook_url or "",
+                "has_custom_certificate": False,
+                "pending_update_count": 0,
+            })
+        # deleteWebhook、close、logOut 等其余方法一律成功
+        return OK_TRUE
+
+
+def parse_params(content_type: str, body: bytes) -> Dict:
+    """解析请求参数：JSON 或表单（表单值本身是 JSON 编码的）"""
+    if not body:
+        return {}
+    if content_type.startswith("application/json"):
+        return json.loads(body)
+    if content_type.startswith("application/x-www-form-urlencoded"):
+        params = {}
+        for key, value in parse_qsl(body.decode()):
+            try:
+                params[key] = json.loads(value)
+            except ValueError:
+                params[key] = value
+        return params
+    # multipart（上传文件）只需要知道调用成功
+    return {}
+
+
+async def serve_api(api: FakeTelegram, host: str, port: int):
+    """极简 HTTP/1.1 服务，支持 keep-alive，路径形如 /bot<token>/<method>"""
+    api.loop = asyncio.get_running_loop()
+    api._has_updates = asyncio.Event()
+
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+        sock = writer.get_extra_info("socket")
+        if sock is not None:
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                _, path, _ = request_line.decode().split(" ", 2)
+                headers = {}
+                while True:
+                    line = await reader.readline()
+                    if line in (b"\r\n", b"\n", b""):
+                        break
+                    name, _, value = line.decode().partition(":")
+                    headers[name.strip().lower()] = value.strip()
+                body = await reader.readexactly(int(headers.get("content-length", 0)))
+
+                method = urlsplit(path).path.rstrip("/").rsplit("/", 1)[-1]
+                started = time.perf_counter()
+                params = parse_params(headers.get("content-type", ""), body)
+                payload = await api.call(method, params)
+                if method != "getUpdates":  # 长轮询的等待时间不算替身的处理耗时
+                    api.busy += time.perf_counter() - started
+                writer.write(
+                    b"HTTP/1.1 200 OK\r\nContent-Type: application/json\r\n"
+                    + f"Content-Length: {len(payload)}\r\n\r\n".encode()
+                    + payload
+                )
+                await writer.drain()
+        except (ConnectionError, asyncio.IncompleteReadError, asyncio.CancelledError):
+            pass  # 客户端断开或替身退出
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+# ==================== 压测驱动 ====================
+def make_callback_update(update_id: int, user_id: int, data: str) -> Dict:
+    user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}", "username": f"user{user_id}"}
+    return {
+        "update_id": update_id,
+        "callback_query": {
+            "id": str(update_id),
+            "from": user,
+            "chat_instance": str(user_id),
+            "data": data,
+            "message": {
+                "message_id": 1,
+                "date": int(time.time()),
+                "chat": {"id": user_id, "type": "private"},
+                "text": "menu",
+            },
+        },
+    }
+
+
+async def post_update(host: str, port: int, path: str, secret: Optional[str], update: Dict):
+    """向机器人的 webhook 推送一条更新（每次新建连接，模拟 Telegram 服务器）"""
+    body = json.dumps(update).encode()
+    headers = (
+        f"POST {path} HTTP/1.1\r\nHost: {host}:{port}\r\n"
+        f"Content-Type: application/json\r\nContent-Length: {len(body)}\r\n"
+        "Connection: close\r\n"
+    )
+    if secret:
+        headers += f"X-Telegram-Bot-Api-Secret-Token: {secret}\r\n"
+    reader, writer = await asyncio.open_connection(host, port)
+    writer.write(headers.encode() + b"\r\n" + body)
+    await writer.drain()
+    status = await reader.readline()
+    writer.close()
+    return status
+
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * pct / 100))]
+
+
+async def run_load(api: FakeTelegram, updates: int, users: int, concurrency: int, timeout: float):
+    """在独立线程的事件循环中运行：推送更新并等待机器人应答"""
+    while not api.ready.is_set():
+        await asyncio.sleep(0.05)
+    if api.mode == "webhook":
+        target = urlsplit(api.webhook_url)
+        host, port, path = target.hostname, target.port or 80, target.path
+        print(f"🎯 webhook: {api.webhook_url}，推送 {updates} 条更新（{users} 个用户）")
+    else:
+        print(f"🎯 长轮询：经 getUpdates 下发 {updates} 条更新（{users} 个用户）")
+
+    loop = asyncio.get_running_loop()
+    user_ids = [100000 + i for i in range(users)]
+    sent: Dict[str, float] = {}
+    answered: Dict[str, float] = {}
+    waiters: Dict[str, asyncio.Future] = {}
+    semaphore = asyncio.Semaphore(concurrency)
+    errors = 0
+
+    def mark_answered(key: str):
+        # 在 API 线程中调用
+        answered.setdefault(key, time.monotonic())
+        loop.call_soon_threadsafe(release, key)
+
+    def release(key: str):
+        waiter = waiters.get(key)
+        if waiter is not None and not waiter.done():
+            waiter.set_result(None)
+
+    api.on_answer = mark_answered
+
+    async def send(update_id: int):
+        nonlocal errors
+        update = make_callback_update(update_id, random.choice(user_ids), random.choice(LOAD_CALLBACKS))
+        key = str(update_id)
+        # 同时未应答的更新不超过 concurrency，延迟不包含在替身这边排队的时间
+        async with semaphore:
+            waiters[key] = loop.create_future()
+            sent[key] = time.monotonic()
+            if api.mode == "webhook":
+                try:
+                    status = await post_update(host, port, path, api.webhook_secret, update)
+                    if b" 200 " not in status:
+                        errors += 1
+                        return
+                except OSError:
+                    errors += 1
+                    return
+            else:
+                api.enqueue([update])
+            try:
+                await asyncio.wait_for(waiters[key], timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    started = time.monotonic()
+    await asyncio.gather(*(send(i) for i in range(1, updates + 1)))
+    elapsed = time.monotonic() - started
+    api.on_answer = None
+
+    latencies = [
+        (answered[key] - sent_at) * 1000
+        for key, sent_at in sent.items() if key in answered
+    ]
+    api_calls = sum(count for method, count in api.calls.items() if method != "getUpdates")
+    print(f"✅ 完成 {len(latencies)}/{updates}，推送失败 {errors}，耗时 {elapsed:.2f}s")
+    print(f"📈 吞吐量: {len(latencies) / elapsed:.1f} updates/s")
+    print(
+        f"⏱️ 端到端延迟 p50 {percentile(latencies, 50):.1f}ms  "
+        f"p90 {percentile(latencies, 90):.1f}ms  p99 {percentile(latencies, 99):.1f}ms"
+    )
+    print(
+        f"🧪 替身处理耗时: 平均 {api.busy / max(api_calls, 1) * 1000:.3f}ms/次，"
+        f"占压测时间 {api.busy / elapsed:.1%}"
+    )
+    print(f"📞 API 调用: {json.dumps(api.calls, ensure_ascii=False)}")
+
+
+async def main_async(args):
+    api = FakeTelegram()
+    server = await serve_api(api, args.host, args.port)
+    print(f"🤖 Telegram 替身已启动: http://{args.host}:{args.port}")
+    async with server:
+        if args.updates:
+            # 压测驱动在另一个线程里跑自己的事件循环，不与 API 服务争用
+            await asyncio.to_thread(
+                asyncio.run, run_load(api, args.updates, args.users, args.concurrency, args.timeout)
+            )
+        else:
+            await server.serve_forever()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="本地 Telegram Bot API 替身与 webhook/长轮询压测")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--updates", type=int, default=0, help="推送的更新数，0 表示只提供 API 替身")
+    parser.add_argument("--users", type=int, default=100, help="模拟的用户数")
+    parser.add_argument("--concurrency", type=int, default=50, help="同时未应答的更新数上限")
+    parser.add_argument("--timeout", type=float, default=30.0, help="每条更新等待机器人应答的秒数")
+    try:
+        asyncio.run(main_async(parser.parse_args()))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()